@@ -1,36 +1,35 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: check_sam_locations.py
-#
-# Purpose: Check and optionall clean dead scratch locations.
-#
-# Usage:
-#
-# check_sam_locations.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -r|--remove           - Remove bad locations.
-# -n|--nfiles           - Maximum number of files to check.
-# --def <defname>       - Parent definition (optional).
-# --list <filelist>     - File list (optional).
-# --file <filename>     - File name (optional).
-# --invalid <file>      - Save bad locations in specified file.
-#
-# Usage notes:
-#
-#
-# 1.  Specify files to check by specifying one of options --def, list, or --file.
-#     Exactly one of these options must be specified.
-#
-# 2.  If option --invalid is specified, save bad file locations.
-#
-# 3.  Bad locations are not removed unless option -r or --remove is specified.
-#     Use with caution.
-#
+"""
+Name: check_sam_locations.py
+
+Purpose: Check and optionall clean dead scratch locations.
+
+Usage:
+
+check_sam_locations.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-r|--remove           - Remove bad locations.
+-n|--nfiles           - Maximum number of files to check.
+--def <defname>       - Parent definition (optional).
+--list <filelist>     - File list (optional).
+--file <filename>     - File name (optional).
+--invalid <file>      - Save bad locations in specified file.
+
+Usage notes:
+
+
+1.  Specify files to check by specifying one of options --def, list, or --file.
+    Exactly one of these options must be specified.
+
+2.  If option --invalid is specified, save bad file locations.
+
+3.  Bad locations are not removed unless option -r or --remove is specified.
+    Use with caution.
+"""
 ########################################################################
 #
 # Created: 24-Mar-2022  H. Greenlee
@@ -38,8 +37,11 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, itertools
+import threading
+import concurrent.futures
 import samweb_cli
+from sam_location_utils import path_exists, strip_scheme, check_dir_paths_exist
 
 # Statistics.
 
@@ -49,25 +51,49 @@ ninvalid = 0    # Number of files with invalid locations.
 nremoved = 0    # Number of invalid locations removed.
 nerror = 0      # Number of errors.
 
+# Number of concurrent existence checks.
+# Each stat on /pnfs is a network round trip, so many checks can be in flight at once.
+
+nstat_workers = 128
+
+# Minimum number of files in a directory for which the directory is listed,
+# instead of checking the existence of each file separately.
+
+nlistdir_min = 4
+
+# Maximum number of paths that are checked sequentially, without a thread pool.
+
+nserial_max = 4
+
+# Number of files that are located, checked, and cleaned at a time.
+
+nchunk = 1000
+
+# Number of concurrent sam location queries.
+
+nsam_workers = 32
+
+# Number of concurrent location removals.
+
+nremove_workers = 8
+
+# Experiment and per-thread samweb clients.
+
+experiment = ''
+thread_data = threading.local()
+
+# Lock protecting statistics updated from worker threads.
+
+stats_lock = threading.Lock()
+
+# Head path accessibility cache {head_path: bool}.
+
+pathdict = {}
+
 # Help function.
 
 def help():
-
-    filename = sys.argv[0]
-    file = open(filename, 'r')
-
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:24] == 'check_sam_locations.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+    print(__doc__)
 
 
 # Check if it is OK to remove this path.
@@ -84,23 +110,212 @@ def check_path(path):
         head_path = '/%s/%s' % tuple(split_path[1:3])
 
         # Check accessibility of this head path.
+        # Each head path is only checked once.
 
-        print('Checking accessibility of head path %s' % head_path)
-        result = os.path.isdir(head_path)
-        if result:
-            print('%s is accessible' % head_path)
+        if head_path in pathdict:
+            result = pathdict[head_path]
         else:
-            print('%s is not accessible' % head_path)
+            print('Checking accessibility of head path %s' % head_path)
+            result = os.path.isdir(head_path)
+            if result:
+                print('%s is accessible' % head_path)
+            else:
+                print('%s is not accessible' % head_path)
+            pathdict[head_path] = result
 
     # Done.
 
     return result
 
 
+# Split an iterable of file names into lists of n files.
+
+def group_files(files, n):
+    it = iter(files)
+    while True:
+        fgroup = list(itertools.islice(it, n))
+        if len(fgroup) == 0:
+            break
+        yield fgroup
+
+
+# Get samweb client for the current thread.
+
+def get_samweb():
+    if not hasattr(thread_data, 'samweb'):
+        thread_data.samweb = samweb_cli.SAMWebClient(experiment=experiment)
+    return thread_data.samweb
+
+
+# Get locations for a group of files.
+# Returns a list of (file name, list of locations) tuples.
+
+def locate_files(samweb, fgroup):
+
+    global nerror
+
+    result = []
+
+    # Get metadata and locations for the whole group in one request.
+    # If this fails (e.g. some file is not declared), fall back to locating
+    # files one at a time.
+
+    try:
+        mdlocs = samweb.getMultipleMetadata(fgroup, locations=True)
+        for mdloc in mdlocs:
+            result.append((mdloc['file_name'], mdloc['locations']))
+    except:
+        result = []
+        for f in fgroup:
+            locs = []
+            try:
+                locs = samweb.locateFile(f)
+            except:
+                locs = []
+                with stats_lock:
+                    nerror += 1
+            result.append((f, locs))
+
+    # Done.
+
+    return result
+
+
+# Check existence of a list of paths concurrently.
+# Returns a dictionary {path: bool}.
+# Paths are grouped by directory.  Directories containing at least
+# nlistdir_min paths are listed once, instead of checking each path separately.
+# A few paths (e.g. option --file) are just checked one at a time.
+
+def check_paths_exist(paths):
+
+    result = {}
+    if len(paths) <= nserial_max:
+        for path in paths:
+            result[path] = path_exists(path)
+        return result
+
+    groups = {}
+    for path in paths:
+        dir = os.path.dirname(path)
+        if dir not in groups:
+            groups[dir] = []
+        groups[dir].append(path)
+
+    nworkers = min(nstat_workers, len(paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
+        tasks = []
+        for dir in groups:
+            dpaths = groups[dir]
+            if len(dpaths) >= nlistdir_min:
+                tasks.append((dpaths, executor.submit(check_dir_paths_exist, dir, dpaths)))
+            else:
+                for path in dpaths:
+                    tasks.append(([path], executor.submit(lambda p: [path_exists(p)], path)))
+        for dpaths, future in tasks:
+            for path, exists in zip(dpaths, future.result()):
+                result[path] = exists
+
+    # Done.
+
+    return result
+
+
+# Remove a list of (file name, location) pairs from sam.
+# Removals are sent concurrently by remove_executor, each worker thread using
+# its own samweb client.
+
+def remove_locations(remove_executor, to_remove):
+
+    list(remove_executor.map(lambda pair: get_samweb().removeFileLocation(*pair), to_remove))
+
+    # Done.
+
+    return
+
+
+# Check locations of a chunk of files, and maybe remove invalid locations.
+
+def check_files(samweb, sam_executor, remove_executor, files, remove, f_invalid):
+
+    global nchecked
+    global nvalid
+    global ninvalid
+    global nremoved
+
+    # Gather all (file, location, path) triples in this chunk.
+    # Locations are fetched from sam in groups of 20 files.
+    # Groups are queried concurrently by sam_executor, each worker thread using
+    # its own samweb client.
+
+    group_locs = list(sam_executor.map(lambda fgroup: locate_files(get_samweb(), fgroup),
+                                       group_files(files, 20)))
+
+    checks = []
+    for flocs in group_locs:
+        for f, locs in flocs:
+            nchecked += 1
+
+            # Loop over locations.
+
+            for loc in locs:
+
+                # Construct full path for this location.
+
+                dir = strip_scheme(loc['full_path'])
+                fp = os.path.join(dir, f)
+
+                # Ignore paths that don't begin with '/pnfs/'
+
+                if fp.startswith('/pnfs/'):
+                    checks.append((f, loc, fp))
+
+    print('Checking %d files' % len(files))
+
+    # Check existence of all paths at once.
+
+    exists = check_paths_exist([fp for f, loc, fp in checks])
+
+    # Loop over checked paths.
+    # Locations to be removed are collected, and removed at the end of the chunk.
+
+    to_remove = []
+    for f, loc, fp in checks:
+        print('Checking path %s' % fp)
+        if exists[fp]:
+            print('Path is valid')
+            nvalid += 1
+        else:
+            print('Path is invalid')
+            ninvalid += 1
+            if f_invalid:
+                f_invalid.write('%s\n' % fp)
+
+            # Maybe remove this location.
+            # Path existence is checked again without caching before removal.
+
+            if remove:
+                if os.path.exists(fp):
+                    print('Location not removed because path exists')
+                elif check_path(fp):
+                    print('Removing location.')
+                    to_remove.append((f, loc['location']))
+                    nremoved += 1
+                else:
+                    print('Location not removed because path is inaccessible')
+
+    remove_locations(remove_executor, to_remove)
+
+    # Done.
+
+    return
+
+
 # Main procedure.
 
 def main(argv):
 
+    global experiment
     global nchecked
     global nvalid
     global ninvalid
@@ -171,9 +386,11 @@ def main(argv):
 
     # Initialize samweb.
 
-    samweb = samweb_cli.SAMWebClient(experiment=experiment)
+    samweb = get_samweb()
 
     # Construct list of files to check.
+    # Sam queries are read completely before any location is removed, since
+    # removals change the query result.
 
     files = []
     if nopt == 0:
@@ -188,65 +405,22 @@ def main(argv):
         files = samweb.listFiles(dimensions=dim)
     elif filelist != '':
         f = open(filelist)
-        for line in f.readlines():
-            files.append(os.path.basename(line.strip()))
-            if nfiles > 0 and len(files) >= nfiles:
-                break
+        lines = f
+        if nfiles > 0:
+            lines = itertools.islice(f, nfiles)
+        files = [os.path.basename(line.strip()) for line in lines]
         f.close()
     elif filename != '':
         files.append(os.path.basename(filename))
 
-    print('Checking %d files' % len(files))
-
-    # Loop over files.
-
-    for f in files:
-        nchecked += 1
-
-        # Get locations from sam.
-
-        locs = []
-        try:
-            locs = samweb.locateFile(f)
-        except:
-            locs = []
-            nerror += 1
+    # Check files in chunks of nchunk files.
+    # The same sam query and removal threads (and their samweb clients) are
+    # used for all chunks.
 
-        # Loop over locations.
-
-        for loc in locs:
-
-            # Construct full path for this location.
-
-            dir = loc['full_path']
-            ncolon = dir.find(':')
-            if ncolon >= 0:
-                dir = dir[ncolon+1:]
-            fp = os.path.join(dir, f)
-
-            # Ignore paths that don't begin with '/pnfs/'
-
-            if fp.startswith('/pnfs/'):
-                print('Checking path %s' % fp)
-                if os.path.exists(fp):
-                    print('Path is valid')
-                    nvalid += 1
-                else:
-                    print('Path is invalid')
-                    ninvalid += 1
-                    if f_invalid:
-                        f_invalid.write('%s\n' % fp)
-
-                    # Maybe remove this location.
-
-                    if remove:
-                        if check_path(fp):
-                            print('Removing location.')
-                            samweb.removeFileLocation(f, loc['location'])
-                            nremoved += 1
-                        else:
-                            print('Location not removed because path is inaccessible')
-                
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nsam_workers) as sam_executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=nremove_workers) as remove_executor:
+        for fchunk in group_files(files, nchunk):
+            check_files(samweb, sam_executor, remove_executor, fchunk, remove, f_invalid)
 
     if f_invalid:
         f_invalid.close()
@@ -1,51 +1,50 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: clean_sam_scratch_locations.py
-#
-# Purpose: Clean dead scratch locations.  Update parameter loc.scratch.
-#
-# Usage:
-#
-# clean_sam_scratch_locations.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -n|--nfiles <n>       - Number of files to query per iteration (default no limit).
-# --def <defname>       - Parent definition (optional, default none).
-# --file <filename>     - File name (optional, default none).
-# --niter <niter>       - Number of iterations (default 1).
-# --nolabel             - Check all files with locations, but no tape label.
-# --invalid_disk <file> - Save files sith invalid persistent disk locations in specified file.
-# --invalid_tape <file> - Save files sith invalid tape locations in specified file.
-#
-# Usage notes:
-#
-#
-# 1.  This script can be invoked without any options.  In that case, every
-#     file in the sam database will be checked.
-#
-# 2.  Use options -n|--nfiles, --def, and/or --file to limit the files being
-#     checked at one time.  With optin --file, only one file is checked.
-#     It is generally a good idea to specify at least one of these options,
-#     to limit the number of files returned by the initial sam query.
-#
-# 3.  The maximum number of files checked is <n>*<niter>.
-#
-# 4.  The initial sam query always includes clause "minus loc.scratch 0."
-#
-# 5.  After checking, parameter loc.scratch is updated to be one of the 
-#     following values.
-#
-#     0 - File does not have a scratch location.
-#     1 - File has a valid scratch location (file still exists).
-#
-# 6.  By default, files that do not have parameter loc.scratch equal to 0 are 
-#     queried (sam dimension "minus loc.scratch 0").  If option --nolabel is
-#     specified, instead use sam dimension "minus tape_label %".
-#
+"""
+Name: clean_sam_scratch_locations.py
+
+Purpose: Clean dead scratch locations.  Update parameter loc.scratch.
+
+Usage:
+
+clean_sam_scratch_locations.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-n|--nfiles <n>       - Number of files to query per iteration (default no limit).
+--def <defname>       - Parent definition (optional, default none).
+--file <filename>     - File name (optional, default none).
+--niter <niter>       - Number of iterations (default 1).
+--nolabel             - Check all files with locations, but no tape label.
+--invalid_disk <file> - Save files sith invalid persistent disk locations in specified file.
+--invalid_tape <file> - Save files sith invalid tape locations in specified file.
+
+Usage notes:
+
+
+1.  This script can be invoked without any options.  In that case, every
+    file in the sam database will be checked.
+
+2.  Use options -n|--nfiles, --def, and/or --file to limit the files being
+    checked at one time.  With optin --file, only one file is checked.
+    It is generally a good idea to specify at least one of these options,
+    to limit the number of files returned by the initial sam query.
+
+3.  The maximum number of files checked is <n>*<niter>.
+
+4.  The initial sam query always includes clause "minus loc.scratch 0."
+
+5.  After checking, parameter loc.scratch is updated to be one of the
+    following values.
+
+    0 - File does not have a scratch location.
+    1 - File has a valid scratch location (file still exists).
+
+6.  By default, files that do not have parameter loc.scratch equal to 0 are
+    queried (sam dimension "minus loc.scratch 0").  If option --nolabel is
+    specified, instead use sam dimension "minus tape_label %".
+"""
 ########################################################################
 #
 # Created: 10-Aug-2021  H. Greenlee
@@ -54,7 +53,11 @@
 
 from __future__ import print_function
 import sys, os
+import threading
+import concurrent.futures
+import queue
 import samweb_cli
+from sam_location_utils import path_exists, strip_scheme
 
 # Statistics.
 
@@ -72,37 +75,98 @@ nupdated = 0
 
 queued_metadata = []
 
+# Metadata updates are sent to sam by a background thread, so that checking
+# can continue while a batch is being sent.
+# Batches of metadata are passed to the background thread through a bounded queue.
+# The first failed update is saved, and later batches are discarded.
+
+metadata_batches = queue.Queue(maxsize=4)
+metadata_thread = None
+metadata_error = None
+
+# Queue of (file name, location) pairs to be removed from sam.
+
+queued_removals = []
+
+# Number of concurrent location removals.
+
+nremove_workers = 8
+
+# Experiment and per-thread samweb clients.
+
+experiment = ''
+thread_data = threading.local()
+
 # Help function.
 
 def help():
+    print(__doc__)
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
-
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:32] == 'clean_sam_scratch_locations.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+
+# Get samweb client for the current thread.
+
+def get_samweb():
+    if not hasattr(thread_data, 'samweb'):
+        thread_data.samweb = samweb_cli.SAMWebClient(experiment=experiment)
+    return thread_data.samweb
+
+
+# Background thread function to send batches of metadata updates to sam.
+# A batch of None means quit.
+# This thread doesn't print anything, so that its output doesn't get mixed
+# with the output of the main thread.
+
+def metadataWorker():
+
+    global metadata_error
+
+    samweb = get_samweb()
+    while True:
+        batch = metadata_batches.get()
+        if batch == None:
+            break
+        if metadata_error != None:
+            continue
+        try:
+            samweb.modifyMetadata(batch)
+        except Exception as e:
+            metadata_error = e
+
+    # Done.
+
+    return
+
+
+# Function to raise the first metadata update error, if any.
+
+def checkMetadataError():
+
+    if metadata_error != None:
+        print('Metadata update failed: %s' % metadata_error)
+        raise metadata_error
+
+    # Done.
+
+    return
 
 
 # Function to flush metadata queue.
+# The queued metadata is handed off to the background thread.
 
 def flushMetadata(samweb):
 
     global queued_metadata
+    global metadata_thread
 
+    checkMetadataError()
     if len(queued_metadata) > 0:
         for md in queued_metadata:
             print('Updating metadata for file %s' % md['file_name'])
-        samweb.modifyMetadata(queued_metadata)
+        if metadata_thread == None:
+            metadata_thread = threading.Thread(target=metadataWorker)
+            metadata_thread.daemon = True
+            metadata_thread.start()
+        metadata_batches.put(queued_metadata)
     queued_metadata = []
 
     # Done.
@@ -110,6 +174,24 @@ def flushMetadata(samweb):
     return
 
 
+# Function to wait for all metadata updates to finish.
+# Reraise the first metadata update error, if any.
+
+def waitMetadata():
+
+    global metadata_thread
+
+    if metadata_thread != None:
+        metadata_batches.put(None)
+        metadata_thread.join()
+        metadata_thread = None
+    checkMetadataError()
+
+    # Done.
+
+    return
+
+
 # Function to update metadata of one file.
 
 def modifyFileMetadata(samweb, f, md):
@@ -134,9 +216,22 @@ def modifyFileMetadata(samweb, f, md):
     return
 
 
+# Remove a list of (file name, location) pairs from sam.
+# Removals are sent concurrently by remove_executor, each worker thread using
+# its own samweb client.
+
+def remove_locations(remove_executor, to_remove):
+
+    list(remove_executor.map(lambda pair: get_samweb().removeFileLocation(*pair), to_remove))
+
+    # Done.
+
+    return
+
+
 # Check a particular location for a file.
 # Returns true if the locations is valid, false if not.
-# Optionally remove invalid locations.
+# Optionally remove invalid locations (removal is queued).
 
 def check_location(samweb, f, loc, remove=False):
 
@@ -144,24 +239,24 @@ def check_location(samweb, f, loc, remove=False):
 
     # Construct the full path of this file.
 
-    dir = loc['full_path']
-    ncolon = dir.find(':')
-    if ncolon >= 0:
-        dir = dir[ncolon+1:]
+    dir = strip_scheme(loc['full_path'])
     fp = os.path.join(dir, f)
     print('Checking location %s' % fp)
 
     # Check whether this file actually exists.
 
-    valid = os.path.exists(fp)
+    valid = path_exists(fp)
 
     # Remove invalid locations.
+    # Path existence is checked again without caching before removal.
 
     if not valid:
-        if remove:
+        if remove and os.path.exists(fp):
+            print('Location not removed because path exists')
+        elif remove:
             nremoved += 1
             print('Removing bad location %s' % fp)
-            samweb.removeFileLocation(f, loc['location'])
+            queued_removals.append((f, loc['location']))
     else:
         print('Location is valid')
 
@@ -172,7 +267,7 @@ def check_location(samweb, f, loc, remove=False):
 
 # Check scratch locations for file.
 
-def check_files(samweb, fgroup, invalid_disk_file, invalid_tape_file):
+def check_files(samweb, remove_executor, fgroup, invalid_disk_file, invalid_tape_file):
 
     global ntape_valid
     global ntape_invalid
@@ -247,6 +342,13 @@ def check_files(samweb, fgroup, invalid_disk_file, invalid_tape_file):
             md_update = {'loc.scratch': flag}
             modifyFileMetadata(samweb, f, md_update)
 
+    # Remove invalid locations found in this group of files.
+    # Quit instead, if a metadata update has failed.
+
+    checkMetadataError()
+    remove_locations(remove_executor, queued_removals)
+    del queued_removals[:]
+
     # Done.
 
     return
@@ -256,6 +358,7 @@ def check_files(samweb, fgroup, invalid_disk_file, invalid_tape_file):
 
 def main(argv):
 
+    global experiment
     global nqueried
     global ntape_valid
     global ntape_invalid
@@ -319,7 +422,7 @@ def main(argv):
 
     # Prepare sam query.
 
-    samweb = samweb_cli.SAMWebClient(experiment=experiment)
+    samweb = get_samweb()
     dim = ''
     if filename != '':
         dim = 'file_name %s' % filename
@@ -336,31 +439,43 @@ def main(argv):
         dim += ' with limit %d' % nfiles
 
     # Iteration loop.
+    # Locations are removed by a pool of threads, which is used for all iterations.
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nremove_workers) as remove_executor:
+
+        nremoved0 = -1
+        nupdated0 = -1
+        while niter > 0 and (nremoved0 != nremoved or nupdated0 != nupdated):
+            nremoved0 = nremoved
+            nupdated0 = nupdated
+            niter -= 1
+
+            # Make sure metadata updates from the previous iteration are finished
+            # before querying again.
+            # The query is read completely before any location is removed or any
+            # metadata is updated, since both change the query result.
 
-    nremoved0 = -1
-    nupdated0 = -1
-    while niter > 0 and (nremoved0 != nremoved or nupdated0 != nupdated):
-        nremoved0 = nremoved
-        nupdated0 = nupdated
-        niter -= 1
-        files = samweb.listFiles(dimensions=dim)
+            flushMetadata(samweb)
+            waitMetadata()
+            files = samweb.listFiles(dimensions=dim)
 
-        # Group files into groups of 20.
+            # Group files into groups of 20.
 
-        fgroup = []
-        for f in files:
-            nqueried += 1
-            fgroup.append(f)
-            if len(fgroup) >= 20:
-                check_files(samweb, fgroup, invalid_disk_file, invalid_tape_file)
-                fgroup = []
+            fgroup = []
+            for f in files:
+                nqueried += 1
+                fgroup.append(f)
+                if len(fgroup) >= 20:
+                    check_files(samweb, remove_executor, fgroup, invalid_disk_file, invalid_tape_file)
+                    fgroup = []
 
-        if len(fgroup) > 0:
-            check_files(samweb, fgroup, invalid_disk_file, invalid_tape_file)
+            if len(fgroup) > 0:
+                check_files(samweb, remove_executor, fgroup, invalid_disk_file, invalid_tape_file)
 
-    # Flush metadata.
+    # Flush metadata and wait for updates to finish.
 
     flushMetadata(samweb)
+    waitMetadata()
 
     # Print statistical summary.
 
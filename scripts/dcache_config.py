@@ -1,22 +1,22 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: dcache_config.py
-#
-# Purpose: Analysis dCache configuraiton.
-#
-# Usage:
-#
-# dcache_config.py [options]
-#
-# Options:
-#
-# -h|--help       - Print help.
-# -e|--experiment - Experiment (default $EXPERIMENT).
-# --min_depth <n> - Minimum depth to print out (default 3).
-# --max_deptn <n> - Maximum depth to analyze (default 7).
-# --md            - Output in markdown format (default plain text).
-#
+"""
+Name: dcache_config.py
+
+Purpose: Analysis dCache configuraiton.
+
+Usage:
+
+dcache_config.py [options]
+
+Options:
+
+-h|--help       - Print help.
+-e|--experiment - Experiment (default $EXPERIMENT).
+--min_depth <n> - Minimum depth to print out (default 3).
+--max_deptn <n> - Maximum depth to analyze (default 7).
+--md            - Output in markdown format (default plain text).
+-j|--jobs <n>   - Number of directories to analyze concurrently (default 16).
+"""
 ########################################################################
 #
 # Created: 21-Jun-2021  H. Greenlee
@@ -24,13 +24,24 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, argparse
+import threading
+import concurrent.futures
 try:
     import urllib.request as urlrequest
 except ImportError:
     import urllib as urlrequest
 
+# Contents of the "Files in Transition" web page, as a single string
+# (downloaded on first use), and sfa status cache {file_family: sfa}.
+
 files_in_transition = None
+sfa_cache = {}
+sfa_lock = threading.Lock()
+
+# Number of directories to analyze concurrently.
+
+njobs = 16
 
 # Mapping from storage_group.file_family to dCache pool.
 
@@ -55,59 +66,19 @@ poolmap = {'uboone.scratch': 'PublicScratchPools',
 # Help function.
 
 def help():
-
-    filename = sys.argv[0]
-    file = open(filename, 'r')
-
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:18] == 'dcache_config.py':
-            doprint = 1
-        elif line[0:6] == '######' and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+    print(__doc__)
 
 
 # Convert bytes or unicode string to default python str type.
-# Works on python 2 and python 3.
+# Works on python 2 and python 3 (on python 2, unicode is encoded by str()).
 
 def convert_str(s):
-
-    result = ''
-
-    if type(s) == type(''):
-
-        # Already a default str.
-        # Just return the original.
-
-        result = s
-
-    elif type(s) == type(u''):
-
-        # Unicode and not str.
-        # Convert to bytes.
-
-        result = s.encode()
-
-    elif type(s) == type(b''):
-
-        # Bytes and not str.
-        # Convert to unicode.
-
-        result = s.decode()
-
+    if isinstance(s, str):
+        return s
+    elif isinstance(s, bytes):
+        return s.decode()
     else:
-
-        # Last resort, use standard str conversion.
-
-        result = str(s)
-
-    return result
+        return str(s)
 
 
 # Print config.
@@ -122,15 +93,8 @@ def print_config(config, markdown):
         fmt = '| %s | %s | %s | %s | %s | %s | %s | %s |'
         headsep = '| --- | --- | --- | --- | --- | --- | --- | --- |'
     else:
-        maxlens = []
-        for tup in config:
-            for i in range(len(tup)):
-                while len(maxlens) < len(tup):
-                    maxlens.append(0)
-                if maxlens[i] < len(tup[i]):
-                    maxlens[i] = len(tup[i])
-        for maxlen in maxlens:
-            fmt += '%%-%ds' % (maxlen+3)
+        maxlens = [max(map(len, column)) for column in zip(*config)]
+        fmt = ''.join(['%%-%ds' % (maxlen+3) for maxlen in maxlens])
 
     # Print config data, including header.        
 
@@ -145,119 +109,183 @@ def print_config(config, markdown):
     return
 
 
+# Read the value of a single dCache tag of a directory.
+# Return empty string if the tag is not defined.
+# The tag file is read with a single os.read call, without creating a file object.
+
+def read_tag(dir, tag):
+    ftag = os.path.join(dir, '.(tag)(%s)' % tag)
+    try:
+        fd = os.open(ftag, os.O_RDONLY)
+    except OSError:
+        return ''
+    try:
+        data = os.read(fd, 4096)
+    except OSError:
+        return ''
+    finally:
+        os.close(fd)
+    return convert_str(data.split(b'\n', 1)[0].strip())
+
+
+# Names of directories that are not descended into.
+
+prune_names = frozenset(('users', 'scratch', 'persistent', 'resilient', 'pnfs', '.upload'))
+
+
+# Names of dCache tags, in the order returned by get_tags.
+
+all_tags = ('storage_group', 'file_family', 'file_family_width', 'file_family_wrapper', 'library')
+
+
 # Get dCache tags for a directory.
-# Return value is a dictionary of {tag: value}
-
-def get_tags(dir):
-    result = {}
-    all_tags = ('storage_group', 'file_family', 'file_family_width', 'file_family_wrapper', 'library')
-    for tag in all_tags:
-        result[tag] = ''
-    ftags = os.path.join(dir, '.(tags)()')
-    for line in open(ftags):
-        n = line.rfind('(')
-        l = line.rfind(')')
-        tag = line[n+1:l]
-        if tag in all_tags:
-            ftag = os.path.join(dir, '.(tag)(%s)' % tag)
-            value = open(ftag).readlines()[0].strip()
-            result[tag] = value
-    return result
-
-
-def get_pool(experiment, tags):
+# Return value is a tuple of tag values, in the same order as all_tags.
+# The set of tags is fixed, so tag files are read directly, without first
+# reading the list of tags from .(tags)().
+# Tag files are read concurrently by tag_executor, since each read is a network round trip.
+
+def get_tags(tag_executor, dir):
+    return tuple(tag_executor.map(lambda tag: read_tag(dir, tag), all_tags))
+
+
+# Get dCache pool group of file family.
+
+def get_pool(experiment, file_family):
 
     # Default pool group is readWritePools.
 
-    tags['pool'] = 'readWritePools'
+    pool = 'readWritePools'
+
+    if file_family != '':
+        key = '%s.%s' % (experiment, file_family)
+        if key in poolmap:
+            pool = poolmap[key]
+    return pool
 
-    if 'file_family' in tags:
-        file_family = tags['file_family']
-        if file_family != '':
-            key = '%s.%s' % (experiment, file_family)
-            if key in poolmap:
-                tags['pool'] = poolmap[key]
-        
 
 # Check SFA status of file family.
 
-def get_sfa(experiment, tags):
+def get_sfa(experiment, file_family):
 
     global files_in_transition
 
-    tags['sfa'] = 'No'
+    sfa = 'No'
 
-    if 'file_family' in tags:
-        file_family = tags['file_family']
-        if file_family != '':
+    if file_family != '':
+        with sfa_lock:
+            if file_family in sfa_cache:
+                return sfa_cache[file_family]
             if files_in_transition == None:
-                files_in_transition = []
 
                 # Download "Files in Transition" web page.
 
                 url = 'https://www-stken.fnal.gov/cgi-bin/enstore_sfa_files_in_transition_cgi.py'
                 result = urlrequest.urlopen(url)
-                for line in result.readlines():
-                    files_in_transition.append(convert_str(line))
+                files_in_transition = convert_str(result.read())
             tag = '%s.%s' % (experiment, file_family)
-            for line in files_in_transition:
-                if line.find(tag) >= 0:
-                    tags['sfa'] = 'Yes'
+            if tag in files_in_transition:
+                sfa = 'Yes'
+            sfa_cache[file_family] = sfa
+    return sfa
 
 
-# Analyze directory.
+# Analyze one directory.
+# Return value is a tuple (row, tags, subdirs), where row is the config tuple
+# for this directory (None if this directory should not be printed), and
+# subdirs is the list of subdirectories to analyze.
 
-def check_dir(config, experiment, dir, depth, min_depth, max_depth, parent_tags):
+def analyze_dir(tag_executor, experiment, dir, depth, min_depth, max_depth, parent_tags):
+
+    # Decide whether to descend into this directory.
 
-    tags = get_tags(dir)
-    get_sfa(experiment, tags)
-    get_pool(experiment, tags)
+    descend = depth < max_depth and os.path.basename(dir) not in prune_names
+
+    # Tags are always needed, since a directory is printed if its tags differ
+    # from its parent's.
+    # Sfa and pool are determined by file family, so it is sufficient to compare tags,
+    # and sfa and pool are only looked up for directories that are printed.
+
+    row = None
+    tags = get_tags(tag_executor, dir)
     if depth <= min_depth or tags != parent_tags:
-        storage_group = tags['storage_group']
-        file_family = tags['file_family']
-        file_family_width = tags['file_family_width']
-        file_family_wrapper = tags['file_family_wrapper']
-        library = tags['library']
-        sfa = tags['sfa']
-        pool = tags['pool']
-
-        # Update config.
-
-        config.append((dir,
-                       storage_group,
-                       file_family,
-                       file_family_width,
-                       file_family_wrapper,
-                       library,
-                       sfa,
-                       pool))
-
-    descend = True
-    if depth >= max_depth:
-        descend = False
-    if descend and os.path.basename(dir) == 'users':
-        descend = False
-    if descend and os.path.basename(dir) == 'scratch':
-        descend = False
-    if descend and os.path.basename(dir) == 'persistent':
-        descend = False
-    if descend and os.path.basename(dir) == 'resilient':
-        descend = False
-    if descend and os.path.basename(dir) == 'pnfs':
-        descend = False
-    if descend and os.path.basename(dir) == '.upload':
-        descend = False
+        storage_group, file_family, file_family_width, file_family_wrapper, library = tags
+        sfa = get_sfa(experiment, file_family)
+        pool = get_pool(experiment, file_family)
+        row = (dir,
+               storage_group,
+               file_family,
+               file_family_width,
+               file_family_wrapper,
+               library,
+               sfa,
+               pool)
+
+    # List subdirectories.
+
+    subdirs = []
     if descend:
-        contents = []
+
+        # Use scandir, so that directory type comes from the directory listing
+        # instead of a separate stat of each entry.
+        # Excluded names are checked first, so that they are never stat'ed.
+        # An entry that can't be stat'ed is skipped, without affecting other entries.
+
+        entries = []
         try:
-            contents = os.listdir(dir)
-        except:
-            contents = []
-        for ele in contents:
-            subpath = os.path.join(dir, ele)
-            if os.path.isdir(subpath) and not ele.startswith('.Trash') and \
-               ele != '.upload' and ele != 'pnfs':
-                check_dir(config, experiment, subpath, depth+1, min_depth, max_depth, tags)
+            with os.scandir(dir) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+        for entry in entries:
+            ele = entry.name
+            if not ele.startswith('.Trash') and ele != '.upload' and ele != 'pnfs':
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.path)
+    return row, tags, subdirs
+
+
+# Analyze directory tree.
+# Directories are analyzed concurrently by a pool of worker threads, since
+# the analysis of each directory is dominated by pnfs round trips.
+# Tag files of each directory are read by a second pool of worker threads.
+# Results are added to config in depth-first order, same as a recursive traversal.
+
+def check_dir(config, experiment, dir, depth, min_depth, max_depth, parent_tags):
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=len(all_tags)*njobs) as tag_executor:
+        pending = {}
+        future = executor.submit(analyze_dir, tag_executor, experiment, dir, depth,
+                                 min_depth, max_depth, parent_tags)
+        pending[future] = (dir, depth)
+        while len(pending) > 0:
+            done, not_done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                d, n = pending.pop(future)
+                row, tags, subdirs = future.result()
+                results[d] = (row, subdirs)
+                for subdir in subdirs:
+                    subfuture = executor.submit(analyze_dir, tag_executor, experiment, subdir, n+1,
+                                                min_depth, max_depth, tags)
+                    pending[subfuture] = (subdir, n+1)
+
+    # Update config.
+    # Walk the analyzed tree depth-first using an explicit stack of directories.
+    # Children are pushed in reverse order, so that they are popped in listing order.
+
+    stack = [dir]
+    while len(stack) > 0:
+        d = stack.pop()
+        row, subdirs = results.pop(d)
+        if row != None:
+            config.append(row)
+        stack.extend(reversed(subdirs))
     return
 
 
@@ -265,35 +293,34 @@ def check_dir(config, experiment, dir, depth, min_depth, max_depth, parent_tags)
 
 def main(argv):
 
+    global njobs
+
     # Parse arguments.
 
     experiment = ''
-    min_depth = 3
-    max_depth = 7
-    markdown = False
     if 'EXPERIMENT' in os.environ:
         experiment = os.environ['EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif (args[0] == '--min_depth') and len(args) > 1:
-            min_depth = int(args[1])
-            del args[0:2]
-        elif (args[0] == '--max_depth') and len(args) > 1:
-            max_depth = int(args[1])
-            del args[0:2]
-        elif args[0] == '--md':
-            markdown = True
-            del args[0]
-        else:
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('--min_depth', type=int, default=3)
+    parser.add_argument('--max_depth', type=int, default=7)
+    parser.add_argument('--md', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=njobs)
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
+
+    experiment = args.experiment
+    min_depth = args.min_depth
+    max_depth = args.max_depth
+    markdown = args.md
+    njobs = max(args.jobs, 1)
 
     rootdir = '/pnfs/%s' % experiment
     if not os.path.exists(rootdir):
@@ -307,7 +334,7 @@ def main(argv):
 
     config = [('Directory', 'Storage Group', 'File family', 'Width', 'Wrapper',
                'Library', 'SFA', 'Pool')]
-    check_dir(config, experiment, rootdir, 2, min_depth, max_depth, {})
+    check_dir(config, experiment, rootdir, 2, min_depth, max_depth, ())
     print_config(config, markdown)
 
     # Done
@@ -1,26 +1,25 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: isartroot.py
-#
-# Purpose: Test whether file is an artroot file.  With no options, return 
-#          exit status 0 if file is an artroot file, nonzero otherise.
-#
-# Usage:
-#
-# isartroot.py [options] <file>
-#
-# Options:
-#
-# -h|--help    - Print help.
-# -n|--invert  - Invert selection (return status 0 for non-artroot root file).
-# -a|--anyroot - Return status 0 for any valid root file.
-# -v|--verbose - Print a human-readable message that matches return status.
-#
-# Arguments:
-#
-# <file> - Path of file.
-#
+"""
+Name: isartroot.py
+
+Purpose: Test whether file is an artroot file.  With no options, return
+         exit status 0 if file is an artroot file, nonzero otherise.
+
+Usage:
+
+isartroot.py [options] <file>
+
+Options:
+
+-h|--help    - Print help.
+-n|--invert  - Invert selection (return status 0 for non-artroot root file).
+-a|--anyroot - Return status 0 for any valid root file.
+-v|--verbose - Print a human-readable message that matches return status.
+
+Arguments:
+
+<file> - Path of file.
+"""
 ########################################################################
 #
 # Use cases.
@@ -51,35 +50,46 @@
 #
 ########################################################################
 
-import sys, os
+import sys, os, argparse
+
+# ROOT module (imported on first use, since importing ROOT is slow).
+
+ROOT = None
+
 
 # Import ROOT module.  Hide command line arguments from ROOT module.
-myargv = sys.argv
-sys.argv = myargv[0:1]
 
-import ROOT
-sys.argv = myargv
+def import_root():
 
+    global ROOT
 
-# Help function.
+    if ROOT == None:
+        myargv = sys.argv
+        sys.argv = myargv[0:1]
+        import ROOT as root_module
+        sys.argv = myargv
+        ROOT = root_module
+
+    # Done.
+
+    return ROOT
 
-def help():
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
+# Check whether file starts with the root file signature.
 
-    doprint=0
-    
-    for line in file.readlines():
-        if line.startswith('# Usage:'):
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+def has_root_magic(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            magic = f.read(4)
+    except IOError:
+        return False
+    return magic == b'root'
+
+
+# Help function.
+
+def help():
+    print(__doc__)
 
 
 # Main procedure.
@@ -90,41 +100,29 @@ def main(argv):
 
     # Parse arguments.
 
-    filepath = ''
-    invert = False
-    anyroot = False
-    verbose = False
-
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        if args[0] == '-n' or args[0] == '--invert' :
-            invert = True
-            del args[0]
-            continue
-        if args[0] == '-a' or args[0] == '--anyroot' :
-            anyroot = True
-            del args[0]
-            continue
-        if args[0] == '-v' or args[0] == '--verbose' :
-            verbose = True
-            del args[0]
-            continue
-        elif args[0].startswith('-'):
-            print('Unknown option %s' % args[0])
-            return 4
-        else:
-
-            # Positional arguments.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-n', '--invert', action='store_true')
+    parser.add_argument('-a', '--anyroot', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('filepaths', nargs='*')
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        return 4
+    if len(args.filepaths) > 1:
+        print('More than one positional argument not allowed.')
+        return 4
 
-            if filepath == '':
-                filepath = args[0]
-                del args[0]
-            else:
-                print('More than one positional argument not allowed.')
-                return 4
+    filepath = ''
+    if len(args.filepaths) > 0:
+        filepath = args.filepaths[0]
+    invert = args.invert
+    anyroot = args.anyroot
+    verbose = args.verbose
 
     # Check validity of options and arguments.
 
@@ -140,10 +138,18 @@ def main(argv):
         print('File %s does not exist.' % filepath)
         return 3
 
+    # Files without the root file signature can't be root files.
+    # Reject these without importing ROOT.
+
+    if not has_root_magic(filepath):
+        if verbose:
+            print('%s exists but is not a valid root file.' % filepath)
+        return 2
+
     # Open file using root.
     # If file can't be opened, return non-zero status (not artroot).
 
-    input = ROOT.TFile.Open(filepath)
+    input = import_root().TFile.Open(filepath)
     if not input or not input.IsOpen():
         if verbose:
             print('%s exists but is not a valid root file.' % filepath)
@@ -1,39 +1,38 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: migrate_sam_definitions.py
-#
-# Purpose: Migrate dataset definitions from source SAM database (SBND or 
-#          ICARUS) to target SAM database (SBN).
-#
-# Usage:
-#
-# migrate_sam_definitions.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -d|--definition <def> - Migrate a particular definition (default none).
-# -n|--ndefinitions<n>  - Number of defiitions migrate (default no limit).
-#
-# Usage notes:
-#
-#
-# 1.  This script queries all definitions from source and target database.
-#     Definitions that exist in source database, but not in target database
-#     are candidates for migration.
-#
-# 2.  This script assumes that any definition that exists in both databases
-#     does not need to be migrated.  That is, existing definitions are not
-#     checked, or in other words, this script does not handle the case of
-#     modified definitions.
-#
-# 3.  If some particular definition is specified via option -d|--definition,
-#     this definition will only be migrated if it does not already exist in the
-#     target database (same as if no definition is specified).
-#     
-#
+"""
+Name: migrate_sam_definitions.py
+
+Purpose: Migrate dataset definitions from source SAM database (SBND or
+         ICARUS) to target SAM database (SBN).
+
+Usage:
+
+migrate_sam_definitions.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-d|--definition <def> - Migrate a particular definition (default none).
+-n|--ndefinitions<n>  - Number of defiitions migrate (default no limit).
+-j|--jobs <n>         - Number of definitions to migrate concurrently (default 16).
+
+Usage notes:
+
+
+1.  This script queries all definitions from source and target database.
+    Definitions that exist in source database, but not in target database
+    are candidates for migration.
+
+2.  This script assumes that any definition that exists in both databases
+    does not need to be migrated.  That is, existing definitions are not
+    checked, or in other words, this script does not handle the case of
+    modified definitions.
+
+3.  If some particular definition is specified via option -d|--definition,
+    this definition will only be migrated if it does not already exist in the
+    target database (same as if no definition is specified).
+"""
 ########################################################################
 #
 # Created: 20-Aug-2021  H. Greenlee
@@ -41,7 +40,9 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, re, argparse
+import threading
+import concurrent.futures
 import samweb_cli
 
 # Statistics.
@@ -51,81 +52,85 @@ ntarget = 0
 nadded = 0
 nskipped = 0
 
-# Help function.
+# Lock protecting statistics updated from worker threads.
 
-def help():
+stats_lock = threading.Lock()
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
+# Number of definitions to migrate concurrently.
 
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:28] == 'migrate_sam_definitions.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+njobs = 16
 
+# Number of top level definitions being migrated, and condition that is
+# notified when one finishes (used to enforce option -n).
 
-# Print definition
+nactive = 0
+slot_cond = threading.Condition(stats_lock)
 
-def print_definition(defdict):
-    for key in defdict:
-        print('%s: %s' % (key, defdict[key]))
-    return
+# Per-thread samweb clients.
 
+thread_data = threading.local()
 
-# Extract dependent definitions (defname: clause) from dimension string.
+# Per-definition locks {defn: lock}, so that a subdefinition shared by
+# several definitions is only migrated by one thread at a time.
 
-def extract_definitions(dim):
+defn_locks = {}
 
-    result = []
-    start = 0
+# Results of check_definition {defn: True/False}, so that each definition is
+# only checked once, no matter how many definitions refer to it.
 
-    # Make sure ':', ')', and '(' are separated by spaces.
+migration_cache = {}
 
-    dim.replace(':', ': ')
-    dim.replace(')', ' ) ')
-    dim.replace('(', ' ( ')
+# Help function.
+
+def help():
+    print(__doc__)
 
-    # Make sure there are no spaces in front of ':'
 
-    while dim.find(' :') >= 0:
-        dim.replace(' :', ':')
+# Print definition
 
-    while start >= 0 and start < len(dim):
+def print_definition(defdict):
+    for key in defdict:
+        print('%s: %s' % (key, defdict[key]))
+    return
 
-        # Search for "defname:"
 
-        n = dim[start:].find('defname:')
-        if n >= 0:
+# Regular expression matching a defname: clause.
+# The definition name is the first word following "defname:", not including
+# any parentheses.
 
-            # Get first word following defname:
+defname_re = re.compile(r'\bdefname\s*:\s*([^\s()]+)')
 
-            subdef = dim[start+8:].split()[0]
-            result.append(subdef)
-            start += 8
 
-        else:
+# Extract dependent definitions (defname: clause) from dimension string.
 
-            # No more defname:'s
+def extract_definitions(dim):
+    return defname_re.findall(dim)
 
-            start = -1
 
-    # Done.
+# Get lock for a particular definition.
 
-    return result
+def defn_lock(defn):
+    with stats_lock:
+        if defn not in defn_locks:
+            defn_locks[defn] = threading.Lock()
+        return defn_locks[defn]
 
 
 # Check definition.
 # Returns True/False depending on whether definition was successfully migrated.
+# Argument target_defs is the set of definitions known to exist in the target
+# database.  Newly migrated definitions are added to this set.
 
-def check_definition(samweb1, samweb2, defn):
+def check_definition(samweb1, samweb2, defn, target_defs):
+    with defn_lock(defn):
+        if defn not in migration_cache:
+            migration_cache[defn] = check_definition_locked(samweb1, samweb2, defn, target_defs)
+        return migration_cache[defn]
+
+
+# Check definition (caller holds the definition lock).
+
+def check_definition_locked(samweb1, samweb2, defn, target_defs):
 
     global nsource
     global ntarget
@@ -151,13 +156,7 @@ def check_definition(samweb1, samweb2, defn):
     # Check whether definition alrady exists in target database.
     # If it exists, return success without any further checking.
 
-    exists = False
-    try:
-        defdict2 = samweb2.descDefinition(defn)
-        exists = True
-    except:
-        exists = False
-    if exists:
+    if defn in target_defs:
         print('Defintion %s already exists in target database.' % defn)
         return True
 
@@ -198,7 +197,8 @@ def check_definition(samweb1, samweb2, defn):
         if dim.find(id) >= 0:
             dim_ok = False
             print('Skipping definition %s because it contains %s' % (defn, id))
-            nskipped += 1
+            with stats_lock:
+                nskipped += 1
             break
 
     # Check embedded definitions.
@@ -206,7 +206,7 @@ def check_definition(samweb1, samweb2, defn):
     if dim_ok:
         subdefs = extract_definitions(dim)
         for subdef in subdefs:
-            dim_ok = check_definition(samweb1, samweb2, subdef)
+            dim_ok = check_definition(samweb1, samweb2, subdef, target_defs)
             if not dim_ok:
                 break
 
@@ -215,9 +215,52 @@ def check_definition(samweb1, samweb2, defn):
     if dim_ok:
         print('Adding definition %s' % defname)
         samweb2.createDefinition(defname, dim, user=user, group=group, description=desc)
+        target_defs.add(defname)
         result = True
-        nadded += 1
-        ntarget += 1
+        with stats_lock:
+            nadded += 1
+            ntarget += 1
+
+    # Done.
+
+    return result
+
+
+# Get samweb clients (source and target) for the current thread.
+
+def get_clients(experiment):
+    if not hasattr(thread_data, 'samweb1'):
+        thread_data.samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
+        thread_data.samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    return thread_data.samweb1, thread_data.samweb2
+
+
+# Migrate one top level definition, unless the requested number of
+# definitions has already been migrated.
+# Each definition being migrated may add a definition, so a definition is
+# not started while the definitions already being migrated could reach the
+# requested number.  Instead, wait for one of them to finish.
+# Each worker thread uses its own samweb clients.
+
+def migrate_definition(experiment, defn, target_defs, ndefs):
+
+    global nactive
+
+    if ndefs > 0:
+        with slot_cond:
+            while nadded < ndefs and nadded + nactive >= ndefs:
+                slot_cond.wait()
+            if nadded >= ndefs:
+                return False
+            nactive += 1
+    try:
+        samweb1, samweb2 = get_clients(experiment)
+        result = check_definition(samweb1, samweb2, defn, target_defs)
+    finally:
+        if ndefs > 0:
+            with slot_cond:
+                nactive -= 1
+                slot_cond.notify_all()
 
     # Done.
 
@@ -232,37 +275,36 @@ def main(argv):
     global ntarget
     global nadded
     global nskipped
+    global njobs
 
     # Parse arguments.
 
     experiment = ''
-    ndefs = 0
-    specific_def = ''
     if 'SAM_EXPERIMENT' in os.environ:
         experiment = os.environ['SAM_EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif (args[0] == '-n' or args[0] == '--ndefinitions') and len(args) > 1:
-            ndefs = int(args[1])
-            del args[0:2]
-        elif (args[0] == '-d' or args[0] == '--definition') and len(args) > 1:
-            specific_def = args[1]
-            del args[0:2]
-        else:
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('-n', '--ndefinitions', type=int, default=0)
+    parser.add_argument('-d', '--definition', default='')
+    parser.add_argument('-j', '--jobs', type=int, default=njobs)
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
+
+    experiment = args.experiment
+    ndefs = args.ndefinitions
+    specific_def = args.definition
+    njobs = max(args.jobs, 1)
 
     # Initialize samweb.
 
-    samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
-    samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    samweb1, samweb2 = get_clients(experiment)
 
     # Get definitions.
 
@@ -284,12 +326,13 @@ def main(argv):
     print('%d definitions needing to be migrated.\n' % len(defsd))
 
 
-    # Loop over definitions that need to be migrated.
+    # Migrate definitions concurrently.
 
-    for defn in defsd:
-        check_definition(samweb1, samweb2, defn)
-        if ndefs > 0 and nadded >= ndefs:
-            break
+    with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor:
+        futures = [executor.submit(migrate_definition, experiment, defn, defs2, ndefs)
+                   for defn in defsd]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
     # Print statistical summary.
@@ -1,46 +1,47 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: migrate_sam_files.py
-#
-# Purpose: Migrate files from source SAM database (SBND or ICARUS) to 
-#          target SAM database (SBN).
-#
-# Usage:
-#
-# migrate_sam_files.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -n|--nfiles <n>       - Number of files to query per iteration (default no limit).
-# --def <defname>       - Parent definition (optional, default none).
-# --file <filename>     - File name (optional, default none).
-# --niter <niter>       - Number of iterations (default 1).
-# --invalid <file>      - Save unmigrated files in specified file.
-#
-# Usage notes:
-#
-#
-# 1.  This script can be invoked without any options.  In that case, every
-#     file in the source sam database will be migrated to the target database.
-#
-# 2.  Use options -n|--nfiles, --def, and/or --file to limit the files being
-#     migrated at one time.  With option --file, only one file is migrated.
-#     It is generally a good idea to specify at least one of these options,
-#     to limit the number of files returned by the initial sam query.
-#
-# 3.  The maximum number of files migrated is <n>*<niter>.
-#
-# 4.  This script checks and updates parameter sbn.migrate in the source database.
-#     The meaning of sbn.migrate is as follows.
-#
-#     0 - File has been migrated successfully (no further checking needed).
-#     1 - File should be checked.
-#     2 - Error.  File can not be migrated because of invalid metadata.
-#     
-#
+"""
+Name: migrate_sam_files.py
+
+Purpose: Migrate files from source SAM database (SBND or ICARUS) to
+         target SAM database (SBN).
+
+Usage:
+
+migrate_sam_files.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-n|--nfiles <n>       - Number of files to query per iteration (default no limit).
+--def <defname>       - Parent definition (optional, default none).
+--file <filename>     - File name (optional, default none).
+--niter <niter>       - Number of iterations (default 1).
+--invalid <file>      - Save unmigrated files in specified file.
+-j|--jobs <n>         - Number of files to check concurrently (default 16).
+--batch_size <n>      - Number of queued metadata updates or locations that
+                        triggers a flush (default 200).
+
+Usage notes:
+
+
+1.  This script can be invoked without any options.  In that case, every
+    file in the source sam database will be migrated to the target database.
+
+2.  Use options -n|--nfiles, --def, and/or --file to limit the files being
+    migrated at one time.  With option --file, only one file is migrated.
+    It is generally a good idea to specify at least one of these options,
+    to limit the number of files returned by the initial sam query.
+
+3.  The maximum number of files migrated is <n>*<niter>.
+
+4.  This script checks and updates parameter sbn.migrate in the source database.
+    The meaning of sbn.migrate is as follows.
+
+    0 - File has been migrated successfully (no further checking needed).
+    1 - File should be checked.
+    2 - Error.  File can not be migrated because of invalid metadata.
+"""
 ########################################################################
 #
 # Created: 9-Aug-2021  H. Greenlee
@@ -48,9 +49,21 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, time, argparse
+import sqlite3
+import threading
+import concurrent.futures
 import samweb_cli
 
+# Source database metadata keys that are never migrated to target database.
+
+strip_keys = frozenset(('file_id', 'process_id', 'create_date', 'update_date', 'update_user',
+                        'sbn.migrate'))
+
+# Metadata keys that are set when a file is declared, but never modified.
+
+nomodify_keys = frozenset(('parents', 'user'))
+
 # Statistics.
 
 nqueried = 0
@@ -63,38 +76,235 @@ nmigrated = 0
 
 queued_metadata1 = []
 
+# Target database location queue (list of (file name, location) pairs).
+
+queued_locations2 = []
+
+# Queue length that triggers a flush.
+
+batch_size = 200
+
+# Number of concurrent location additions when flushing location queue.
+
+nlocation_workers = 8
+
+# Target samweb clients for adding locations, one per location worker.
+# Flushes are serialized by flush_lock, so each client is only used by one
+# thread at a time.
+
+location_clients = []
+
+# Lock serializing queue flushes.
+
+flush_lock = threading.Lock()
+
+# Lock protecting statistics and metadata queue updated from worker threads.
+
+stats_lock = threading.Lock()
+
+# Number of files to check concurrently.
+
+njobs = 16
+
+# Per-file locks {f: lock}, so that a parent shared by several files is only
+# checked by one thread at a time.
+
+file_locks = {}
+
+# Per-thread samweb clients.
+
+thread_data = threading.local()
+
+# Maximum number of files per bulk metadata query.
+
+nprefetch = 20
+
+# Results of check_file {f: True/False}, so that each file (in particular,
+# a parent shared by many files) is only checked once per run.
+
+check_results = {}
+
+# Persistent cache of files that are known to be fully migrated (sbn.migrate=0
+# in source database), shared between runs.  Parents found in this cache are
+# not checked again.  New entries are committed in batches of
+# migrated_commit_size.  Entries expire after migrated_ttl seconds, since the
+# migrate flag may be reset, or the file may be removed from target database.
+# Entries for files returned by the main query (i.e. files that are not
+# migrated) are deleted.
+
+migrated_db_file = os.path.join(os.path.expanduser('~'), '.cache', 'sbnutil', 'migrated_files.db')
+migrated_db = None
+migrated_experiment = ''
+migrated_pending = []
+migrated_commit_size = 100
+migrated_ttl = 86400
+migrated_lock = threading.Lock()
+
 # Help function.
 
 def help():
+    print(__doc__)
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
-
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:22] == 'migrate_sam_files.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
 
+# Add a list of (file name, location) pairs to target database.
+
+def add_locations(samweb2, locs):
+    for f, location in locs:
+        samweb2.addFileLocation(f, location)
 
-# Function to flush metadata queue.
+    # Done.
+
+    return
 
-def flushMetadata(samweb):
+
+# Function to flush metadata and location queues.
+# Locations are added first, so that the migrate flag is never reset in
+# the source database before the file's locations exist in the target database.
+# Locations are added concurrently, each location worker using its own
+# target client (see location_clients).
+
+def flushMetadata(samweb1, samweb2):
 
     global queued_metadata1
+    global queued_locations2
+
+    with flush_lock:
+        with stats_lock:
+            mds = queued_metadata1
+            queued_metadata1 = []
+            locs = queued_locations2
+            queued_locations2 = []
+        if len(locs) > 0:
+            nworkers = min(nlocation_workers, len(locs))
+            while len(location_clients) < nworkers:
+                location_clients.append(samweb_cli.SAMWebClient(experiment='sbn'))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
+                list(executor.map(add_locations, location_clients[:nworkers],
+                                  [locs[i::nworkers] for i in range(nworkers)]))
+        if len(mds) > 0:
+            print('Updating metadata for %d files in source database.' % len(mds))
+            samweb1.modifyMetadata(mds)
+            add_migrated([md['file_name'] for md in mds if md.get('sbn.migrate') == 0])
+
+    # Done.
+
+    return
+
+
+# Open persistent migrated file cache.
+# If the cache can't be opened, run without it.
+
+def open_migrated_db(experiment):
+
+    global migrated_db
+    global migrated_experiment
+
+    migrated_experiment = experiment
+    try:
+        cache_dir = os.path.dirname(migrated_db_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        migrated_db = sqlite3.connect(migrated_db_file, check_same_thread=False)
+        migrated_db.execute('PRAGMA journal_mode=WAL')
+        migrated_db.execute('CREATE TABLE IF NOT EXISTS migrated '
+                            '(experiment TEXT, file_name TEXT, time INTEGER, '
+                            'PRIMARY KEY (experiment, file_name))')
+        migrated_db.commit()
+    except (OSError, sqlite3.Error):
+        migrated_db = None
+
+    # Done.
+
+    return
+
+
+# Check whether file is in persistent migrated file cache.
+
+def is_migrated(f):
+
+    if migrated_db == None:
+        return False
+    with migrated_lock:
+        row = migrated_db.execute('SELECT 1 FROM migrated WHERE experiment=? AND file_name=? '
+                                  'AND time>=?',
+                                  (migrated_experiment, f, int(time.time()) - migrated_ttl)).fetchone()
+    return row != None
+
+
+# Commit pending entries to persistent migrated file cache.
+
+def commit_migrated():
+
+    global migrated_pending
+
+    if migrated_db == None:
+        return
+    with migrated_lock:
+        if len(migrated_pending) > 0:
+            now = int(time.time())
+            migrated_db.executemany('INSERT OR REPLACE INTO migrated VALUES (?, ?, ?)',
+                                    [(migrated_experiment, f, now) for f in migrated_pending])
+            migrated_db.commit()
+            migrated_pending = []
 
-    if len(queued_metadata1) > 0:
-        for md in queued_metadata1:
-            print('Updating metadata for file %s' % md['file_name'])
-        samweb.modifyMetadata(queued_metadata1)
-    queued_metadata1 = []
+    # Done.
+
+    return
+
+
+# Add files to persistent migrated file cache.
+
+def add_migrated(files):
+
+    if migrated_db == None:
+        return
+    with migrated_lock:
+        migrated_pending.extend(files)
+        commit = len(migrated_pending) >= migrated_commit_size
+    if commit:
+        commit_migrated()
+
+    # Done.
+
+    return
+
+
+# Remove files from persistent migrated file cache.
+
+def remove_migrated(files):
+
+    global migrated_pending
+
+    if migrated_db == None:
+        return
+    with migrated_lock:
+        fset = set(files)
+        migrated_pending = [f for f in migrated_pending if f not in fset]
+        migrated_db.executemany('DELETE FROM migrated WHERE experiment=? AND file_name=?',
+                                [(migrated_experiment, f) for f in files])
+        migrated_db.commit()
+
+    # Done.
+
+    return
+
+
+# Function to add a location of one file in target database.
+
+def addFileLocation(samweb1, samweb2, f, location):
+
+    global queued_locations2
+
+    # Add location to queue.
+
+    with stats_lock:
+        queued_locations2.append((f, location))
+        flush = len(queued_locations2) >= batch_size
+
+    # Maybe flush queue.
+
+    if flush:
+        flushMetadata(samweb1, samweb2)
 
     # Done.
 
@@ -103,7 +313,7 @@ def flushMetadata(samweb):
 
 # Function to update metadata of one file.
 
-def modifyFileMetadata(samweb, f, md):
+def modifyFileMetadata(samweb1, samweb2, f, md):
 
     global queued_metadata1
 
@@ -113,12 +323,14 @@ def modifyFileMetadata(samweb, f, md):
 
     # Add metadata to queue.
 
-    queued_metadata1.append(md)
+    with stats_lock:
+        queued_metadata1.append(md)
+        flush = len(queued_metadata1) >= batch_size
 
     # Maybe flush queue.
 
-    if len(queued_metadata1) > 21:
-        flushMetadata(samweb)
+    if flush:
+        flushMetadata(samweb1, samweb2)
 
     # Done.
 
@@ -133,11 +345,63 @@ def print_metadata(f, md):
         print('%s = %s' % (k, md[k]))
 
 
+# Get metadata and locations for a list of files using a single request.
+# Return value is a tuple of dictionaries ({file_name: metadata}, {file_name: locations}),
+# or (None, None) if the request failed.
+
+def prefetch_metadata(samweb, files):
+
+    mds = {}
+    locs = {}
+    if len(files) > 0:
+        try:
+            for md in samweb.getMultipleMetadata(files, locations=True):
+                locs[md['file_name']] = md.pop('locations')
+                mds[md['file_name']] = md
+        except:
+            mds = None
+            locs = None
+
+    # Done.
+
+    return mds, locs
+
+
+# Find parents that are already fully migrated (sbn.migrate=0 in source database).
+# Parents in the persistent migrated file cache are accepted directly.  The
+# remaining parents that haven't been checked during this run are queried
+# together using a single sam query (a single parent is just checked normally).
+# Return value is a set of parent file names.
+
+def find_migrated_parents(samweb1, parents):
+
+    result = set()
+    unknown = []
+    for parent in parents:
+        pfname = parent['file_name']
+        if is_migrated(pfname):
+            result.add(pfname)
+        elif pfname not in check_results:
+            unknown.append(pfname)
+    if len(unknown) > 1:
+        dim = 'file_name %s and sbn.migrate 0 with availability anylocation,anystatus' % \
+              ','.join(unknown)
+        migrated = samweb1.listFiles(dimensions=dim)
+        result.update(migrated)
+        add_migrated(migrated)
+
+    # Done.
+
+    return result
+
+
 # Check file metadata.
+# Arguments md1 and md2 are prefetched source and target metadata (None if not
+# prefetched, target metadata {} if file is known not to exist in target database).
 #
 # Returns the original value of sbn.migrate in the source database (0, 1, or None).
 
-def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
+def check_metadata(samweb1, samweb2, experiment, f, invalid_fh, md1=None, md2=None):
 
     global ndeclared
     global nmodified
@@ -146,7 +410,8 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
 
     # Get metadata for this file.
 
-    md1 = samweb1.getMetadata(f)
+    if md1 == None:
+        md1 = samweb1.getMetadata(f)
 
     # Check migrate flag.
     # If the migrate flag is zero, this file does not require further checking.
@@ -163,9 +428,8 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
 
     # Remove keys that we never want to migrate in the target database.
 
-    for k in ('file_id', 'process_id', 'create_date', 'update_date', 'update_user', 'sbn.migrate'):
-        if k in md1:
-            del md1[k]
+    for k in strip_keys.intersection(md1):
+        del md1[k]
 
     # Add keys that are not in the original database.
 
@@ -178,12 +442,9 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
         new_checksum = []
         checksum_updated = False
         for checksum in md1['checksum']:
-            if checksum.startswith('md5:'):
-                value = checksum[4:]
-                while len(value) < 32:
-                    value = '0' + value
-                    checksum_updated = True
-                checksum = 'md5:%s' % value
+            if checksum.startswith('md5:') and len(checksum) < 36:
+                checksum = 'md5:%s' % checksum[4:].zfill(32)
+                checksum_updated = True
             new_checksum.append(checksum)
         if checksum_updated:
             print('Fixing md5 checksum for file %s' % f)
@@ -193,6 +454,7 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
 
     parents_ok = True
     if 'parents' in md1:
+        migrated_parents = find_migrated_parents(samweb1, md1['parents'])
         for parent in md1['parents']:
 
             # Remove file_id from parent dictionary.
@@ -207,10 +469,12 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
                 parents_ok = False
 
             # Make sure parent is declared in target database.
+            # Parents that are already fully migrated don't need to be checked.
 
             if parents_ok:
                 pfname = parent['file_name']
-                parents_ok = check_file(samweb1, samweb2, experiment, pfname, invalid_file)
+                if pfname not in migrated_parents:
+                    parents_ok = check_file(samweb1, samweb2, experiment, pfname, invalid_fh)
 
     # Quit if this file has any retired parents.
 
@@ -223,43 +487,42 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
         mdr['sbn.migrate'] = 2
         samweb1.modifyFileMetadata(f, md=mdr)
         migrate = 2
-        nmodified += 1
+        with stats_lock:
+            nmodified += 1
         return migrate
 
     # At this point, we think that we need to add or update metadata for file f in 
     # the target database.
 
-    md2 = {}
-    md_update = {}
-    try:
-        md2 = samweb2.getMetadata(f)
-    except:
-        md2 = {}
+    if md2 == None:
+        try:
+            md2 = samweb2.getMetadata(f)
+        except samweb_cli.FileNotFound:
+            md2 = {}
 
     # Calculate metadata update for target datagase.
     # 
     # When modifying metadata (as opposed to declaring for the first time),
     # never update certain fields, including 'user' and 'parents.'
 
-    for k in md1:
+    md_update = {k: md1[k] for k in md1
+                 if k not in md2 or (k not in nomodify_keys and md2[k] != md1[k])}
+    for k in md_update:
         if k in md2:
-            if md2[k] != md1[k] and k != 'parents' and k != 'user':
-                print('Updating field %s' % k)
-                md_update[k] = md1[k]
-        else:
-            #print('Adding field %s' % k)
-            md_update[k] = md1[k]
+            print('Updating field %s' % k)
 
     if len(md_update) > 0:
         if len(md2) > 0:
             print('Updating metadata for file %s in target database.' % f)
             #print(md_update)
             samweb2.modifyFileMetadata(f, md=md_update)
-            nmodified += 1
+            with stats_lock:
+                nmodified += 1
         else:
             print('Declaring file %s in target database.' % f)
             samweb2.declareFile(md=md_update)
-            ndeclared += 1
+            with stats_lock:
+                ndeclared += 1
     else:
         print('Metadata for file %s in target database is already up to date.' % f)
 
@@ -269,22 +532,26 @@ def check_metadata(samweb1, samweb2, experiment, f, invalid_file):
 
 
 # Check file locations.
+# Arguments locs1 and locs2 are prefetched source and target locations (None if
+# not prefetched).
+# Argument invalid_fh is an open file for saving unmigrated file names (or None).
 # Return True if location check was successful, False otherwise.
 
-def check_locations(samweb1, samweb2, f, invalid_file):
+def check_locations(samweb1, samweb2, f, invalid_fh, locs1=None, locs2=None):
 
     global nlocations
 
     print('Checking locations for file %s' % f)
-    locs1 = samweb1.locateFile(f)
-    locs2_ok = False
-    locs2 = []
-    try:
-        locs2 = samweb2.locateFile(f)
-        locs2_ok = True
-    except:
-        locs2 = []
-        locs2_ok = False
+    if locs1 == None:
+        locs1 = samweb1.locateFile(f)
+    locs2_ok = True
+    if locs2 == None:
+        try:
+            locs2 = samweb2.locateFile(f)
+            locs2_ok = True
+        except samweb_cli.FileNotFound:
+            locs2 = []
+            locs2_ok = False
 
     # If locate-file failed in target database, that means that this file has not been
     # declared in the target database.
@@ -294,12 +561,12 @@ def check_locations(samweb1, samweb2, f, invalid_file):
     if not locs2_ok:
         print('Unable to check locations for file %s' % f)
         print('File may not be declared.')
-        if invalid_file != '':
-            fl = open(invalid_file, 'a')
-            fl.write('%s\n' % f)
-            fl.close()
+        if invalid_fh != None:
+            with stats_lock:
+                invalid_fh.write('%s\n' % f)
         return False
 
+    locs2_paths = set([loc2['full_path'] for loc2 in locs2])
     has_loc1 = False
     for loc1 in locs1:
         has_loc1 = True
@@ -311,18 +578,13 @@ def check_locations(samweb1, samweb2, f, invalid_file):
 
             # Look for location with the same full_path.
 
-            loc_match = False
-            for loc2 in locs2:
-                fp2 = loc2['full_path']
-                if fp2 == fp1:
-                    loc_match = True
-                    break
-            if loc_match:
+            if fp1 in locs2_paths:
                 print('Location already exists in target database.')
             else:
                 print('Adding location in target database.')
-                samweb2.addFileLocation(f, loc1['location'])
-                nlocations += 1
+                addFileLocation(samweb1, samweb2, f, loc1['location'])
+                with stats_lock:
+                    nlocations += 1
 
     if not has_loc1:
         print('No locations found.')
@@ -332,26 +594,105 @@ def check_locations(samweb1, samweb2, f, invalid_file):
     return True
 
 
+# Get lock for a particular file.
+
+def file_lock(f):
+    with stats_lock:
+        if f not in file_locks:
+            file_locks[f] = threading.Lock()
+        return file_locks[f]
+
+
+# Get samweb clients (source and target) for the current thread.
+
+def get_clients(experiment):
+    if not hasattr(thread_data, 'samweb1'):
+        thread_data.samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
+        thread_data.samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    return thread_data.samweb1, thread_data.samweb2
+
+
+# Check a group of files from a worker thread, using this thread's samweb clients.
+# Source and target metadata and locations for the whole group are fetched
+# with bulk requests.
+
+def process_files(experiment, files, invalid_fh):
+
+    samweb1, samweb2 = get_clients(experiment)
+    remove_migrated(files)
+    mds1, locs1 = prefetch_metadata(samweb1, files)
+    if mds1 == None:
+        mds1 = {}
+        locs1 = {}
+
+    # Only query metadata for files that exist in target database.
+
+    mds2 = None
+    locs2 = None
+    try:
+        files2 = samweb2.listFiles(dimensions='file_name %s with availability anylocation,anystatus'
+                                   % ','.join(files))
+        mds2, locs2 = prefetch_metadata(samweb2, files2)
+    except:
+        mds2 = None
+        locs2 = None
+
+    for f in files:
+        md2 = None
+        loc2 = None
+        if mds2 != None:
+            md2 = mds2.get(f, {})
+            loc2 = locs2.get(f)
+        check_file(samweb1, samweb2, experiment, f, invalid_fh,
+                   mds1.get(f), md2, locs1.get(f), loc2)
+
+    # Done.
+
+    return
+
+
 # Check file metadata and locations.
 # Return True of metadata + location check was successful, False otherwise.
+# Optional arguments md1, md2, locs1, and locs2 are prefetched metadata and
+# locations (see check_metadata and check_locations).
+
+def check_file(samweb1, samweb2, experiment, f, invalid_fh,
+               md1=None, md2=None, locs1=None, locs2=None):
+    with file_lock(f):
+        if f not in check_results:
+            check_results[f] = check_file_locked(samweb1, samweb2, experiment, f,
+                                                 invalid_fh, md1, md2, locs1, locs2)
+        return check_results[f]
+
+
+# Check file metadata and locations (caller holds the file lock).
 
-def check_file(samweb1, samweb2, experiment, f, invalid_file):
+def check_file_locked(samweb1, samweb2, experiment, f, invalid_fh, md1, md2, locs1, locs2):
 
     global nmigrated
 
     ok = True
 
-    migrate = check_metadata(samweb1, samweb2, experiment, f, invalid_file)
+    migrate = check_metadata(samweb1, samweb2, experiment, f, invalid_fh, md1, md2)
+    if migrate == 0:
+        add_migrated([f])
     if migrate != 0 and migrate != 2:
-        ok = check_locations(samweb1, samweb2, f, invalid_file)
+
+        # If file was known not to exist in target database, it has just been
+        # declared, and has no locations there yet.
+
+        if md2 == {}:
+            locs2 = []
+        ok = check_locations(samweb1, samweb2, f, invalid_fh, locs1, locs2)
         if ok:
 
             # Update parameter sbn.migrate to be 0 in source database.
 
             print('Setting parameter sbn.migrate to 0 in source database')
             md_update = {'sbn.migrate': 0}
-            modifyFileMetadata(samweb1, f, md_update)
-            nmigrated += 1
+            modifyFileMetadata(samweb1, samweb2, f, md_update)
+            with stats_lock:
+                nmigrated += 1
     if ok and migrate == 2:
         ok = False
 
@@ -360,6 +701,19 @@ def check_file(samweb1, samweb2, experiment, f, invalid_file):
     return ok
 
 
+# Wait for a batch of submitted file groups, then flush queued updates.
+
+def finish_batch(samweb1, samweb2, futures):
+
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
+    flushMetadata(samweb1, samweb2)
+
+    # Done.
+
+    return
+
+
 # Main procedure.
 
 def main(argv):
@@ -369,52 +723,53 @@ def main(argv):
     global nmodified
     global nlocations
     global nmigrated
+    global njobs
+    global batch_size
 
     # Parse arguments.
 
     experiment = ''
-    nfiles = 0
-    defname = ''
-    filename = ''
-    niter = 1
-    invalid_file = ''
     if 'SAM_EXPERIMENT' in os.environ:
         experiment = os.environ['SAM_EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif (args[0] == '-n' or args[0] == '--nfiles') and len(args) > 1:
-            nfiles = int(args[1])
-            del args[0:2]
-        elif (args[0] == '--def') and len(args) > 1:
-            defname = args[1]
-            del args[0:2]
-        elif (args[0] == '--file') and len(args) > 1:
-            filename = args[1]
-            del args[0:2]
-        elif args[0] == '--niter' and len(args) > 1:
-            niter = int(args[1])
-            del args[0:2]
-        elif args[0] == '--invalid' and len(args) > 1:
-            invalid_file = args[1]
-            del args[0:2]
-        else:
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
-
-    if invalid_file != '' and os.path.exists(invalid_file):
-        os.remove(invalid_file)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('-n', '--nfiles', type=int, default=0)
+    parser.add_argument('--def', dest='defname', default='')
+    parser.add_argument('--file', default='')
+    parser.add_argument('--niter', type=int, default=1)
+    parser.add_argument('--invalid', default='')
+    parser.add_argument('-j', '--jobs', type=int, default=njobs)
+    parser.add_argument('--batch_size', type=int, default=batch_size)
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
+
+    experiment = args.experiment
+    nfiles = args.nfiles
+    defname = args.defname
+    filename = args.file
+    niter = args.niter
+    invalid_file = args.invalid
+    njobs = max(args.jobs, 1)
+    batch_size = max(args.batch_size, 1)
+
+    # Open file for saving unmigrated files (replacing any existing file).
+
+    invalid_fh = None
+    if invalid_file != '':
+        invalid_fh = open(invalid_file, 'w')
 
     # Prepare sam query.
 
     samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
     samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    open_migrated_db(experiment)
     dim = ''
     if filename != '':
         dim = 'file_name %s' % filename
@@ -424,23 +779,52 @@ def main(argv):
         dim = 'file_id > 0'
     dim += ' minus sbn.migrate 0,2 with availability anylocation,anystatus'
     if nfiles > 0:
-        dim += ' with limit %d' % nfiles
+        dim += ' with limit %d' % (nfiles * niter)
+
+    # Query files for all iterations at once, and process them in batches
+    # of nfiles files (one batch per iteration).
+    # If there is only one batch (no file limit), the query result is streamed,
+    # and files are submitted to the thread pool in groups while the rest of
+    # the result is still being received.
+    # Otherwise, the (limited) query result is read at once, so that the query
+    # isn't left open and idle while waiting for each batch to finish.
+
+    ngroup = nprefetch
+    if nfiles > 0:
+        ngroup = max(1, min(nprefetch, (nfiles + njobs - 1) // njobs))
+    files = []
+    if niter > 0:
+        files = samweb1.listFiles(dimensions=dim, stream=(nfiles <= 0))
 
     # Iteration loop.
 
-    while niter > 0:
-        niter -= 1
-        files = samweb1.listFiles(dimensions=dim)
-        if len(files) == 0:
-            print('No more files.')
-            break
-        nqueried += len(files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor:
+        futures = []
+        group = []
+        nbatch = 0
         for f in files:
-            check_file(samweb1, samweb2, experiment, f, invalid_file)
+            nqueried += 1
+            nbatch += 1
+            group.append(f)
+            if len(group) >= ngroup or nbatch == nfiles:
+                futures.append(executor.submit(process_files, experiment, group, invalid_fh))
+                group = []
+            if nbatch == nfiles:
+                finish_batch(samweb1, samweb2, futures)
+                futures = []
+                nbatch = 0
+        if len(group) > 0:
+            futures.append(executor.submit(process_files, experiment, group, invalid_fh))
+        finish_batch(samweb1, samweb2, futures)
+    if nqueried == 0:
+        print('No more files.')
 
     # Flush metadata.
 
-    flushMetadata(samweb1)
+    flushMetadata(samweb1, samweb2)
+    commit_migrated()
+    if invalid_fh != None:
+        invalid_fh.close()
 
     # Print statistical summary.
 
@@ -1,37 +1,36 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: migrate_sam_locations.py
-#
-# Purpose: Migrate locations from source SAM database (SBND or ICARUS) to 
-#          target SAM database (SBN).
-#
-# Usage:
-#
-# migrate_sam_locations.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -n|--nfiles <n>       - Number of files to query per iteration (default no limit).
-# --def <defname>       - Parent definition (optional, default none).
-# --file <filename>     - File name (optional, default none).
-# --niter <niter>       - Number of iterations (default 1).
-# --scratch             - Migrate scratch locations (default no scratch).
-#
-# Usage notes.
-#
-# 1.  This script is a companion to migrate_sam_files.py.  Migrate_sam_files.py
-#     also migrates locations, but never migrates scrartch locations.  This
-#     script can be used to migrate scratch locations (if inoked with option 
-#     --scratch).
-#
-# 2.  This script never updates any sam metadata in either the source or
-#     target sam database.  This implies that in order to migrate locations.
-#     metadata must exist in both databases already (e.g. by invoking 
-#     migrate_sam_files.py).
-#
+"""
+Name: migrate_sam_locations.py
+
+Purpose: Migrate locations from source SAM database (SBND or ICARUS) to
+         target SAM database (SBN).
+
+Usage:
+
+migrate_sam_locations.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-n|--nfiles <n>       - Number of files to query per iteration (default no limit).
+--def <defname>       - Parent definition (optional, default none).
+--file <filename>     - File name (optional, default none).
+--niter <niter>       - Number of iterations (default 1).
+--scratch             - Migrate scratch locations (default no scratch).
+
+Usage notes.
+
+1.  This script is a companion to migrate_sam_files.py.  Migrate_sam_files.py
+    also migrates locations, but never migrates scrartch locations.  This
+    script can be used to migrate scratch locations (if inoked with option
+    --scratch).
+
+2.  This script never updates any sam metadata in either the source or
+    target sam database.  This implies that in order to migrate locations.
+    metadata must exist in both databases already (e.g. by invoking
+    migrate_sam_files.py).
+"""
 ########################################################################
 #
 # Created: 15-Sep-2021  H. Greenlee
@@ -39,7 +38,7 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, argparse
 import samweb_cli
 
 # Statistics.
@@ -47,44 +46,54 @@ import samweb_cli
 nqueried = 0
 nlocations = 0
 
+# Maximum number of files per bulk location query.
+
+nprefetch = 20
+
 # Help function.
 
 def help():
+    print(__doc__)
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
-
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:26] == 'migrate_sam_locations.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+
+# Get locations for a list of files using a single request.
+# Return value is a dictionary {file_name: locations}, or None if the request failed.
+
+def prefetch_locations(samweb, files):
+
+    result = {}
+    if len(files) > 0:
+        try:
+            for md in samweb.getMultipleMetadata(files, locations=True):
+                result[md['file_name']] = md['locations']
+        except:
+            result = None
+
+    # Done.
+
+    return result
 
 
 # Check file locations.
+# Arguments locs1 and locs2 are prefetched source and target locations (None if
+# not prefetched).
 # Return True if location check was successful, False otherwise.
 
-def check_locations(samweb1, samweb2, f, doscratch):
+def check_locations(samweb1, samweb2, f, doscratch, locs1=None, locs2=None):
 
     global nlocations
 
     print('Checking locations for file %s' % f)
-    locs1 = samweb1.locateFile(f)
-    locs2_ok = False
-    locs2 = []
-    try:
-        locs2 = samweb2.locateFile(f)
-        locs2_ok = True
-    except:
-        locs2 = []
-        locs2_ok = False
+    if locs1 == None:
+        locs1 = samweb1.locateFile(f)
+    locs2_ok = True
+    if locs2 == None:
+        try:
+            locs2 = samweb2.locateFile(f)
+            locs2_ok = True
+        except samweb_cli.FileNotFound:
+            locs2 = []
+            locs2_ok = False
 
     # If locate-file failed in target database, that means that this file has not been
     # declared in the target database.
@@ -96,6 +105,7 @@ def check_locations(samweb1, samweb2, f, doscratch):
         print('File may not be declared.')
         return False
 
+    locs2_paths = set([loc2['full_path'] for loc2 in locs2])
     has_loc1 = False
     for loc1 in locs1:
         has_loc1 = True
@@ -107,13 +117,7 @@ def check_locations(samweb1, samweb2, f, doscratch):
 
             # Look for location with the same full_path.
 
-            loc_match = False
-            for loc2 in locs2:
-                fp2 = loc2['full_path']
-                if fp2 == fp1:
-                    loc_match = True
-                    break
-            if loc_match:
+            if fp1 in locs2_paths:
                 print('Location already exists in target database.')
             else:
                 print('Adding location in target database.')
@@ -138,40 +142,31 @@ def main(argv):
     # Parse arguments.
 
     experiment = ''
-    nfiles = 0
-    defname = ''
-    filename = ''
-    niter = 1
-    doscratch = False
     if 'SAM_EXPERIMENT' in os.environ:
         experiment = os.environ['SAM_EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif (args[0] == '-n' or args[0] == '--nfiles') and len(args) > 1:
-            nfiles = int(args[1])
-            del args[0:2]
-        elif (args[0] == '--def') and len(args) > 1:
-            defname = args[1]
-            del args[0:2]
-        elif (args[0] == '--file') and len(args) > 1:
-            filename = args[1]
-            del args[0:2]
-        elif args[0] == '--niter' and len(args) > 1:
-            niter = int(args[1])
-            del args[0:2]
-        elif args[0] == '--scratch':
-            doscratch = True
-            del args[0]
-        else:
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('-n', '--nfiles', type=int, default=0)
+    parser.add_argument('--def', dest='defname', default='')
+    parser.add_argument('--file', default='')
+    parser.add_argument('--niter', type=int, default=1)
+    parser.add_argument('--scratch', action='store_true')
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
+
+    experiment = args.experiment
+    nfiles = args.nfiles
+    defname = args.defname
+    filename = args.file
+    niter = args.niter
+    doscratch = args.scratch
 
     # Prepare sam query.
 
@@ -197,8 +192,27 @@ def main(argv):
             print('No more files.')
             break
         nqueried += len(files)
-        for f in files:
-            check_locations(samweb1, samweb2, f, doscratch)
+
+        # Fetch source and target locations in groups.
+        # Files that are not declared in target database are not included in
+        # the target query, and are located (and reported) one at a time.
+
+        for i in range(0, len(files), nprefetch):
+            group = files[i:i+nprefetch]
+            locs1 = prefetch_locations(samweb1, group)
+            if locs1 == None:
+                locs1 = {}
+            locs2 = {}
+            try:
+                files2 = samweb2.listFiles(dimensions='file_name %s with availability anylocation,anystatus'
+                                           % ','.join(group))
+                locs2 = prefetch_locations(samweb2, files2)
+            except:
+                locs2 = None
+            if locs2 == None:
+                locs2 = {}
+            for f in group:
+                check_locations(samweb1, samweb2, f, doscratch, locs1.get(f), locs2.get(f))
 
     # Print statistical summary.
 
@@ -1,32 +1,31 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: migrate_sam_users.py
-#
-# Purpose: Migrate users and groups from source SAM database (SBND or
-#          ICARUS) to target SAM database (SBN).
-#
-# Usage:
-#
-# migrate_sam_users.py [options]
-#
-# Options:
-#
-# -h|--help             - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-# -u|--user <user>      - Check particular user (default all).
-#
-# Usage notes:
-#
-# 1.  This script queries all users from source and target database
-#     and adds missing users in the target database.
-#
-# 2.  Group membership, and grid subjects are checked for each user.
-#     Groups and grid subjects will generallly be the union of groups
-#     and grid subjects from all source databases.
-#
-# 3.  Status (active/inactive) is not checked.
-#
+"""
+Name: migrate_sam_users.py
+
+Purpose: Migrate users and groups from source SAM database (SBND or
+         ICARUS) to target SAM database (SBN).
+
+Usage:
+
+migrate_sam_users.py [options]
+
+Options:
+
+-h|--help             - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+-u|--user <user>      - Check particular user (default all).
+
+Usage notes:
+
+1.  This script queries all users from source and target database
+    and adds missing users in the target database.
+
+2.  Group membership, and grid subjects are checked for each user.
+    Groups and grid subjects will generallly be the union of groups
+    and grid subjects from all source databases.
+
+3.  Status (active/inactive) is not checked.
+"""
 ########################################################################
 #
 # Created: 20-Aug-2021  H. Greenlee
@@ -34,7 +33,9 @@
 ########################################################################
 
 from __future__ import print_function
-import sys, os
+import sys, os, argparse
+import threading
+import concurrent.futures
 import samweb_cli
 
 # Statistics.
@@ -44,25 +45,128 @@ ntarget_users = 0
 nusers_added = 0
 nusers_updated = 0
 
+# Number of concurrent user queries.
+
+nuser_workers = 16
+
+# Lock protecting statistics updated from worker threads.
+
+stats_lock = threading.Lock()
+
+# Per-thread samweb clients.
+
+thread_data = threading.local()
+
 # Help function.
 
 def help():
+    print(__doc__)
+
+
+# Get samweb clients (source and target) for the current thread.
+
+def get_clients(experiment):
+    if not hasattr(thread_data, 'samweb1'):
+        thread_data.samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
+        thread_data.samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    return thread_data.samweb1, thread_data.samweb2
+
+
+# Describe one user in the source database, or in the target database if
+# target is true, using the current thread's samweb clients.
+
+def describe_user(experiment, user, target):
+    samweb1, samweb2 = get_clients(experiment)
+    if target:
+        return samweb2.describeUser(user)
+    return samweb1.describeUser(user)
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
 
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:22] == 'migrate_sam_users.py':
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+# Describe a collection of users using concurrent queries.
+# Return value is a dictionary {user: user dictionary}.
+
+def describe_users(executor, experiment, users, target):
+
+    result = {}
+    users = list(users)
+    for user, userdict in zip(users, executor.map(lambda user: describe_user(experiment, user, target),
+                                                  users)):
+        result[user] = userdict
+
+    # Done.
+
+    return result
+
+
+# Add user to target database.
+
+def add_user(samweb2, user, userdict):
+
+    global nusers_added
+    global ntarget_users
+
+    print('Adding user %s' % user)
+    firstname = userdict['first_name']
+    lastname = userdict['last_name']
+    email = userdict['email']
+    samweb2.addUser(user, firstname=firstname, lastname=lastname, email=email)
+    with stats_lock:
+        nusers_added += 1
+        ntarget_users += 1
+
+    # Done.
+
+    return
+
+
+# Check groups and grid subjects of one user in target database.
+
+def check_user(samweb2, user, userdict1, userdict2):
+
+    global nusers_updated
+
+    #print('Checking groups for user %s' % user)
+
+    # Check groups.
+
+    groups1 = userdict1['groups']
+    groups2 = userdict2['groups']
+    #print(groups1)
+    #print(groups2)
+    add_groups = []
+    for group in groups1:
+        if not group in groups2:
+            print('Adding group %s for user %s' % (group, user))
+            update_group = True
+            add_groups.append(group)
+    #print(groups2)
+    if len(add_groups) > 0:
+        print('Updating groups for user %s' % user)
+        samweb2.modifyUser(user, addgroups=add_groups)
+
+    # Check grid subjects.
+
+    grids1 = userdict1['grid_subjects']
+    grids2 = userdict2['grid_subjects']
+    #print(grids1)
+    #print(grids2)
+    update_grid = False
+    for grid in grids1:
+        if not grid in grids2:
+            print('Adding grid subject %s for user %s' % (grid, user))
+            try:
+                samweb2.modifyUser(user, addgridsubject=grid)
+                update_grid = True
+            except:
+                print('Failed to update grid subject %s for user %s' % (grid, user))
+
+    if len(add_groups) > 0 or update_grid:
+        with stats_lock:
+            nusers_updated += 1
+
+    # Done.
+
+    return
 
 
 # Main procedure.
@@ -77,29 +181,27 @@ def main(argv):
     # Parse arguments.
 
     experiment = ''
-    user = ''
     if 'SAM_EXPERIMENT' in os.environ:
         experiment = os.environ['SAM_EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif (args[0] == '-u' or args[0] == '--user') and len(args) > 1:
-            user = args[1]
-            del args[0:2]
-        else:
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('-u', '--user', default='')
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
+
+    experiment = args.experiment
+    user = args.user
 
     # Initialize samweb.
 
-    samweb1 = samweb_cli.SAMWebClient(experiment=experiment)
-    samweb2 = samweb_cli.SAMWebClient(experiment='sbn')
+    samweb1, samweb2 = get_clients(experiment)
 
     # Add missing users.
 
@@ -118,62 +220,28 @@ def main(argv):
     print('%d users in target database.'% len(users2))
     print('%d users missing in target datagase.' % len(usersd))
 
-    # Add missing users.
+    # Users are described, added, and checked by a pool of worker threads.
+    # Each worker thread uses its own samweb clients.
 
-    print('\nChecking users.')
-    for user in usersd:
-        print('Adding user %s' % user)
-        userdict = samweb1.describeUser(user)
-        firstname = userdict['first_name']
-        lastname = userdict['last_name']
-        email = userdict['email']
-        samweb2.addUser(user, firstname=firstname, lastname=lastname, email=email)
-        nusers_added += 1
-        ntarget_users += 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nuser_workers) as executor:
 
-    # Loop over all users from source database and check groups and grid subjects.
-
-    print('\nChecking groups and grid subjects.')
-    for user in users1:
-        #print('Checking groups for user %s' % user)
-        userdict1 = samweb1.describeUser(user)
-        userdict2 = samweb2.describeUser(user)
-
-        # Check groups.
-
-        groups1 = userdict1['groups']
-        groups2 = userdict2['groups']
-        #print(groups1)
-        #print(groups2)
-        add_groups = []
-        for group in groups1:
-            if not group in groups2:
-                print('Adding group %s for user %s' % (group, user))
-                update_group = True
-                add_groups.append(group)
-        #print(groups2)
-        if len(add_groups) > 0:
-            print('Updating groups for user %s' % user)
-            samweb2.modifyUser(user, addgroups=add_groups)
-
-        # Check grid subjects.
-
-        grids1 = userdict1['grid_subjects']
-        grids2 = userdict2['grid_subjects']
-        #print(grids1)
-        #print(grids2)
-        update_grid = False
-        for grid in grids1:
-            if not grid in grids2:
-                print('Adding grid subject %s for user %s' % (grid, user))
-                try:
-                    samweb2.modifyUser(user, addgridsubject=grid)
-                    update_grid = True
-                except:
-                    print('Failed to update grid subject %s for user %s' % (grid, user))
-
-        if len(add_groups) > 0 or update_grid:
-            nusers_updated += 1
+        # Describe all source users once.
+
+        userdicts1 = describe_users(executor, experiment, users1, False)
+
+        # Add missing users.
+
+        print('\nChecking users.')
+        list(executor.map(lambda user: add_user(get_clients(experiment)[1], user, userdicts1[user]),
+                          usersd))
+
+        # Loop over all users from source database and check groups and grid subjects.
+
+        print('\nChecking groups and grid subjects.')
+        userdicts2 = describe_users(executor, experiment, users1, True)
+        list(executor.map(lambda user: check_user(get_clients(experiment)[1], user,
+                                                  userdicts1[user], userdicts2[user]),
+                          users1))
 
     # Print statistical summary.
 
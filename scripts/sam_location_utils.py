@@ -0,0 +1,69 @@
+"""
+Name: sam_location_utils.py
+
+Purpose: Path existence checks shared by check_sam_locations.py and
+         clean_sam_scratch_locations.py.
+
+This module is not a script.  It is installed next to the scripts that
+import it.
+"""
+########################################################################
+
+import os, time
+
+# Directory existence cache {dir: (exists, time)}.
+# Entries expire after dir_cache_ttl seconds.
+
+dir_exists_cache = {}
+dir_cache_ttl = 300.
+
+# Check whether a path exists.
+# Existence of the parent directory is cached, so that files in a directory
+# that is known not to exist are rejected without touching the filesystem.
+
+def path_exists(path):
+
+    dir = os.path.dirname(path)
+    now = time.monotonic()
+    if dir in dir_exists_cache and now - dir_exists_cache[dir][1] < dir_cache_ttl:
+        dir_ok = dir_exists_cache[dir][0]
+    else:
+        dir_ok = os.path.isdir(dir)
+        dir_exists_cache[dir] = (dir_ok, now)
+
+    # Done.
+
+    return dir_ok and os.path.exists(path)
+
+
+# Strip the location prefix (e.g. "enstore:" or "dcache:") from a sam location path.
+
+def strip_scheme(path):
+    head, sep, tail = path.partition(':')
+    if sep:
+        return tail
+    return head
+
+
+# Check existence of several files in the same directory by listing the directory once.
+# Returns a list of bools, one for each path.
+
+def check_dir_paths_exist(dir, paths):
+
+    now = time.monotonic()
+    names = set()
+    if dir in dir_exists_cache and not dir_exists_cache[dir][0] and \
+       now - dir_exists_cache[dir][1] < dir_cache_ttl:
+        dir_ok = False
+    else:
+        try:
+            with os.scandir(dir) as it:
+                names = set([entry.name for entry in it])
+            dir_ok = True
+        except OSError:
+            dir_ok = False
+        dir_exists_cache[dir] = (dir_ok, now)
+
+    # Done.
+
+    return [os.path.basename(path) in names for path in paths]
@@ -1,34 +1,46 @@
 #! /usr/bin/env python
-########################################################################
-#
-# Name: sbnoms_metadata_extractor.py
-#
-# Purpose: SAM metadata extractor for artroot and non-artroot files.
-#          Use sam_metadata_dumper to extract internal sam metadata from
-#          artroot files.  Otherwise, read metadata from associated .json
-#          file.  Json format metadata written to standard output.
-#
-# Usage:
-#
-# sbnpoms_metadata_extractor.py [options] <file>
-#
-# Arguments:
-#
-# <file> - Path of file.
-#
-# Options:
-#
-# -h|--help - Print help.
-# -e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
-#
+"""
+Name: sbnoms_metadata_extractor.py
+
+Purpose: SAM metadata extractor for artroot and non-artroot files.
+         Use sam_metadata_dumper to extract internal sam metadata from
+         artroot files.  Otherwise, read metadata from associated .json
+         file.  Json format metadata written to standard output.
+
+Usage:
+
+sbnpoms_metadata_extractor.py [options] <file> [<file> ...]
+
+Arguments:
+
+<file> - Path of file.  If more than one file is specified, metadata
+         for all files are extracted using a single invocation of
+         sam_metadata_dumper, and the output is a json dictionary
+         {file_name: metadata}.
+
+Options:
+
+-h|--help - Print help.
+-e|--experiment <exp> - Experiment (default $SAM_EXPERIMENT).
+"""
 ########################################################################
 #
 # Created: 31-Aug-2021  H. Greenlee
 #
 ########################################################################
 
-import sys, os, subprocess, json, string
+import sys, os, subprocess, json, re, copy, time, tempfile, argparse
+import concurrent.futures
+import functools
 import samweb_cli
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 samweb = None
 experiment = ''
@@ -37,25 +49,63 @@ registered_data_streams = None
 data_stream_conversions = {'outBNB': 'bnb',
                            'outNUMI': 'numi'}
 
+# Directory and lifetime (seconds) of local file cache of registered data streams.
+
+data_streams_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'sbnutil')
+data_streams_cache_lifetime = 3600
+
+# Caches of parent metadata, used while checking parents.
+# Sam metadata is keyed by parent name (None if parent is not declared).
+# Metadata of local parent files is keyed by absolute path.
+
+parent_md_cache = {}
+local_md_cache = {}
+
+# Cache of raw sam_metadata_dumper (or json file) metadata {(abs_path, mtime_ns): metadata}.
+
+dumper_cache = {}
+
+# Number of local parent files to extract metadata from concurrently.
+
+ndumper_workers = min(8, os.cpu_count() or 1)
+
+# Cache of json files in each directory {dir: {json_noext: json_file_name}}.
+
+json_dir_cache = {}
+
 # Help function.
 
 def help():
+    print(__doc__)
+
 
-    filename = sys.argv[0]
-    file = open(filename, 'r')
+# Parse json document (str or bytes) into python object.
+# Use orjson, if available, otherwise standard json module.
+# Documents that orjson rejects (e.g. NaN) are parsed again by the standard
+# json module.  So are documents containing long digit strings, which might
+# be integers beyond 64 bits, that orjson would silently convert to float.
 
-    doprint=0
-    
-    for line in file.readlines():
-        if line.startswith('# sbnpoms_metadata_extractor.py'):
-            doprint = 1
-        elif (line.startswith('######') or line.startswith('# Usage notes:')) and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end='')
-            else:
-                print()
+def json_loads(data):
+    if orjson != None:
+        if isinstance(data, str):
+            long_digits = re.search(r'\d{20}', data)
+        else:
+            long_digits = re.search(rb'\d{20}', data)
+        if not long_digits:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(data)
+
+
+# Pretty print json object to standard output, with sorted keys and final newline.
+# Always use the standard json module here, since orjson output is formatted
+# differently (NaN, floats, non-ascii characters).
+
+def json_print(obj):
+    json.dump(obj, sys.stdout, sort_keys=True, indent=2)
+    print()   # Json dump misses final newline.
 
 
 # Get initialized samweb object.
@@ -71,37 +121,47 @@ def get_samweb():
     return samweb
 
 
-# Return true of the argument is a uuid.
-
-def is_uuid(s):
-    result = False
-    if len(s) == 37:
-        result = True
-        for i in range(len(s)):
-            if i==0 or i==9 or i==14 or i==19 or i==24:
-                if s[i] != '-':
-                    result = False
-                    break
-            else:
-                if s[i] not in string.hexdigits:
-                    result = False
-                    break
+# Regular expression matching a uuid, including leading dash, as added by
+# ifdh renameOutput: "-hex(8)-hex(4)-hex(4)-hex(4)-hex(12)"
 
-    # Done.
-
-    return result
+uuid_re = re.compile(r'-[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
 
 
-# Return matching json file for specified data file (usually root file).
-# Return empty string if no matching json file is found.
-# This function understands that data files may have been renamed unique
-# by "ifdh renameOutput".  
+# Return true of the argument is a uuid.
 
-def matching_json_file(data_file):
-    result = ''
-    data_path = os.path.abspath(data_file)
-    dir = os.path.dirname(data_path)
-    fname = os.path.basename(data_path)
+def is_uuid(s):
+    return len(s) == 37 and uuid_re.match(s) != None
+
+
+# Return json files in a directory as a dictionary {json_noext: json_file_name},
+# where json_noext is the json file name without ".json" and one more extension
+# (e.g. "file.root.json" and "file.json" are both keyed as "file").
+# Each directory is only scanned once.
+
+def json_files(dir):
+    if dir not in json_dir_cache:
+        jsons = {}
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    f = entry.name
+                    if f.endswith('.json'):
+                        f_noext = os.path.splitext(f[:-5])[0]
+                        if f_noext not in jsons:
+                            jsons[f_noext] = f
+        except OSError:
+            pass
+        json_dir_cache[dir] = jsons
+    return json_dir_cache[dir]
+
+
+# Return the names that a matching json file for a data file name may have,
+# not including ".json" and one more extension, as a tuple (fname_noext, fname_trunc).
+# Results are cached, since the same file names are looked up repeatedly
+# while checking parents.
+
+@functools.lru_cache(maxsize=None)
+def json_noext_names(fname):
 
     # fname_noext is the root file name without directory and extension.
 
@@ -117,105 +177,230 @@ def matching_json_file(data_file):
         if is_uuid(uuid):
             fname_trunc = fname_noext[:-37]
 
-    # Hunt for matching json files.
+    # Done.
 
-    for f in os.listdir(dir):
-        if f.endswith('.json'):
-            f_noext = os.path.splitext(f[:-5])[0]
-            if f_noext == fname_noext or f_noext == fname_trunc:
-                result = os.path.join(dir, f)
-                break
+    return fname_noext, fname_trunc
+
+
+# Return matching json file for data file fname in absolute directory dir.
+# Return empty string if no matching json file is found.
+
+def matching_json_in_dir(dir, fname):
+    result = ''
+
+    # Look up matching json files in (cached) directory contents.
+
+    jsons = json_files(dir)
+    for f_noext in json_noext_names(fname):
+        if f_noext in jsons:
+            result = os.path.join(dir, jsons[f_noext])
+            break
 
     # Done.
 
     return result
 
 
-# Check the validity of a single parent.
-# Return value is a guaranteed valid list of parents (may be empty list)
-# Fcl list also updated to include fcls associated with virtual parents.
-# Update mc event_count if a parent file contains parameter 
-# mc.generated_event_count.
+# Return matching json file for specified data file (usually root file).
+# Return empty string if no matching json file is found.
+# This function understands that data files may have been renamed unique
+# by "ifdh renameOutput".  
 
-def check_parent(parentarg, dir, fcllist, mc_event_count):
+def matching_json_file(data_file):
+    dir, fname = os.path.split(os.path.abspath(data_file))
+    return matching_json_in_dir(dir, fname)
 
-    result = []
 
-    # Parent arg can be passed in different ways depending on the source.
+# Functions to extract parent file name from parent argument, keyed by argument type.
+# Parent arg can be passed in different ways depending on the source.
+
+parent_name_extractors = {
+    str: lambda parentarg: parentarg,
+    bytes: lambda parentarg: parentarg.decode('utf8'),
+    dict: lambda parentarg: parentarg['file_name'] if 'file_name' in parentarg \
+                            else parentarg.get('file_id', '')}
+
+
+# Extract parent file name from a parent argument.
+# Return value may be empty string or non-string (file id) if there is no file name.
+
+def parent_name(parentarg):
+    extractor = parent_name_extractors.get(type(parentarg))
+    if extractor == None:
+        return ''
+    return extractor(parentarg)
+
 
-    parent = ''
-    if type(parentarg) == type(''):
-        parent = parentarg
-    elif type(parentarg) == type(b''):
-        parent = parentarg.decode('utf8')
-    elif type(parentarg) == type({}):
-        if 'file_name' in parentarg:
-            parent = parentarg['file_name']
-        elif 'file_id' in parentarg:
-            parent = parentarg['file_id']
-    if parent == '' or type(parent) != type(''):
-        raise FileNotFoundError
+# Fetch sam metadata of a list of parents into the parent metadata cache
+# using a single query.
+# Parents that are already cached are not queried again.
+# If the bulk query fails, parents are left uncached, and are queried one
+# at a time by check_parents.
 
+def prefetch_parents(parentargs):
 
-    # Check whether this parent file has metadata already.
+    names = []
+    for parentarg in parentargs:
+        parent = parent_name(parentarg)
+        if parent != '' and type(parent) == type('') and parent not in parent_md_cache \
+           and parent not in names:
+            names.append(parent)
+    if len(names) < 2:
+        return
 
     samweb = get_samweb()
-    has_metadata = False
-    mdparent = {}
     try:
-        mdparent = samweb.getMetadata(parent)
-        has_metadata = True
+        mds = samweb.getMultipleMetadata(names)
     except samweb_cli.FileNotFound:
-        has_metadata = False
+        return
+    for md in mds:
+        parent_md_cache[md['file_name']] = md
 
-    if has_metadata:
+    # Parents missing from the result are not declared.
 
-        # If this parent has metadata, return this one file in the form of a list.
-        # Don't add anything to fcl list.
+    for parent in names:
+        if parent not in parent_md_cache:
+            parent_md_cache[parent] = None
 
-        result = [parent]
+    # Done.
 
-        # Maybe update mc event_count.
+    return
 
-        if 'mc.generated_event_count' in mdparent:
-            mc_event_count[0] = mdparent['mc.generated_event_count']
-        elif (not 'parents' in mdparent or len(mdparent['parents']) == 0) and 'event_count' in mdparent:
-            mc_event_count[0]  = mdparent['event_count']
 
-    else:
+# Extract metadata of local parent files concurrently into the local metadata cache.
+# Only parents that are known not to be declared (see prefetch_parents) and
+# that exist locally (or have a json file) are extracted.
 
-        # If this parent doesn't have metadata, try to locate file.
+def prefetch_local_parents(parentargs, dir):
 
-        local_file = os.path.join(dir, parent)
-        if os.path.exists(local_file) or matching_json_file(local_file) != '':
+    local_files = {}
+    for parentarg in parentargs:
+        parent = parent_name(parentarg)
+        if parent in parent_md_cache and parent_md_cache[parent] == None:
+            local_file = os.path.join(dir, parent)
+            local_path = os.path.abspath(local_file)
+            if local_path not in local_md_cache and local_path not in local_files and \
+               (os.path.exists(local_file) or matching_json_in_dir(*os.path.split(local_path)) != ''):
+                local_files[local_path] = local_file
+    if len(local_files) < 2:
+        return
 
-            # Found local file.  Extract parent information from file.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ndumper_workers) as executor:
+        futures = {}
+        for local_path in local_files:
+            futures[local_path] = executor.submit(get_metadata, local_files[local_path])
+        for local_path in futures:
+            local_md_cache[local_path] = futures[local_path].result()
 
-            md = get_metadata(local_file)
+    # Done.
 
-            if 'parents' in md:
-                for prnt in md['parents']:
-                    result.extend(check_parent(prnt, dir, fcllist, mc_event_count))
+    return
 
-            # Append fcl file to front of fcl list.
 
-            if 'fcl.name' in md and not md['fcl.name'] in fcllist:
-                fcllist.insert(1, md['fcl.name'])
+# Check the validity of a list of parents.
+# Return value is a guaranteed valid list of parents (may be empty list)
+# Fcl list also updated to include fcls associated with virtual parents.
+# Update mc event_count if a parent file contains parameter 
+# mc.generated_event_count.
+#
+# Parents of local (virtual) parent files are checked depth-first, using an
+# explicit stack instead of recursion.  Each stack entry is a tuple
+# (local_path, md, iterator over remaining parents), where local_path and md
+# are None for the original list of parents.  A local parent that is its own
+# ancestor is skipped.
+
+def check_parents(parentargs, dir, fcllist, mc_event_count):
+
+    result = []
+
+    prefetch_parents(parentargs)
+    prefetch_local_parents(parentargs, dir)
+    stack = [(None, None, iter(parentargs))]
+    ancestors = set()
+    while len(stack) > 0:
+        local_path, md, parents = stack[-1]
+        try:
+            parentarg = next(parents)
+        except StopIteration:
+
+            # All parents of the file on top of the stack have been checked.
+
+            stack.pop()
+            if md != None:
+                ancestors.discard(local_path)
+
+                # Append fcl file to front of fcl list.
+
+                if 'fcl.name' in md and not md['fcl.name'] in fcllist:
+                    fcllist.insert(1, md['fcl.name'])
+
+                # Maybe update mc event_count.
+
+                if 'mc.generated_event_count' in md:
+                    mc_event_count[0] = md['mc.generated_event_count']
+                elif (not 'parents' in md or len(md['parents']) == 0) and 'event_count' in md:
+                    mc_event_count[0] = md['event_count']
+            continue
+
+        parent = parent_name(parentarg)
+        if parent == '' or type(parent) != type(''):
+            raise FileNotFoundError
+
+        # Check whether this parent file has metadata already.
+        # Each parent is only queried once, since the same parent can be reached
+        # through more than one branch of the parentage tree.
+
+        if parent not in parent_md_cache:
+            samweb = get_samweb()
+            try:
+                parent_md_cache[parent] = samweb.getMetadata(parent)
+            except samweb_cli.FileNotFound:
+                parent_md_cache[parent] = None
+        mdparent = parent_md_cache[parent]
+
+        if mdparent != None:
+
+            # If this parent has metadata, add this one file to the result.
+            # Don't add anything to fcl list.
+
+            result.append(parent)
 
             # Maybe update mc event_count.
 
-            if 'mc.generated_event_count' in md:
-                mc_event_count[0] = md['mc.generated_event_count']
-            elif (not 'parents' in md or len(md['parents']) == 0) and 'event_count' in md:
-                mc_event_count[0] = md['event_count']
+            if 'mc.generated_event_count' in mdparent:
+                mc_event_count[0] = mdparent['mc.generated_event_count']
+            elif (not 'parents' in mdparent or len(mdparent['parents']) == 0) and 'event_count' in mdparent:
+                mc_event_count[0]  = mdparent['event_count']
+            continue
 
-        else:
+        # If this parent doesn't have metadata, try to locate file.
+
+        local_file = os.path.join(dir, parent)
+        local_path = os.path.abspath(local_file)
+        if not (local_path in local_md_cache or os.path.exists(local_file) or \
+                matching_json_in_dir(*os.path.split(local_path)) != ''):
 
             # Couldn't find file.  Raise exception.
 
             print('Couldn\'t find file %s' % local_file)
             raise FileNotFoundError
 
+        # Found local file.  Extract parent information from file, and check
+        # its parents before updating fcl list and mc event_count.
+
+        if local_path in ancestors:
+            continue
+        if local_path not in local_md_cache:
+            local_md_cache[local_path] = get_metadata(local_file)
+        md = local_md_cache[local_path]
+        prnts = []
+        if 'parents' in md:
+            prnts = md['parents']
+            prefetch_parents(prnts)
+            prefetch_local_parents(prnts, dir)
+        ancestors.add(local_path)
+        stack.append((local_path, md, iter(prnts)))
+
     # Done.
 
     return result
@@ -242,11 +427,9 @@ def validate_parents(md, dir):
         # Metadata contains a nonempty list of parents.
 
         parents = md['parents']
-        new_parents = []
         fcllist = []
         mc_event_count = [-1]
-        for parent in parents:
-            new_parents.extend(check_parent(parent, dir, fcllist, mc_event_count))
+        new_parents = check_parents(parents, dir, fcllist, mc_event_count)
         if len(new_parents) == 0:
 
             # If updated parent list is empty, delete 'parents' from metadata.
@@ -284,6 +467,44 @@ def validate_parents(md, dir):
     return
 
 
+# Get list of registered data streams.
+# The list is cached in a local file (one per experiment) in the user's cache
+# directory, which is reused for up to data_streams_cache_lifetime seconds,
+# since this script is typically invoked once per file by batch jobs.
+
+def get_registered_data_streams():
+
+    path = os.path.join(data_streams_cache_dir, 'sbnpoms_data_streams_%s.json' % experiment)
+    try:
+        if time.time() - os.stat(path).st_mtime < data_streams_cache_lifetime:
+            with open(path, 'rb') as f:
+                return json_loads(f.read())
+    except (OSError, ValueError):
+        pass
+
+    # Query data streams from sam, and update cache file.
+    # Cache file is replaced atomically, since other jobs may be reading it.
+    # The new cache file is written to a uniquely named temporary file first.
+
+    samweb = get_samweb()
+    data_streams = samweb.listValues('data_streams')
+    tmppath = None
+    try:
+        if not os.path.isdir(data_streams_cache_dir):
+            os.makedirs(data_streams_cache_dir)
+        fd, tmppath = tempfile.mkstemp(dir=data_streams_cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(list(data_streams), f)
+        os.replace(tmppath, path)
+    except OSError:
+        if tmppath != None and os.path.exists(tmppath):
+            os.remove(tmppath)
+
+    # Done.
+
+    return data_streams
+
+
 # Validate ane maybe update data_stream metadata.
 
 def validate_data_stream(md):
@@ -299,8 +520,7 @@ def validate_data_stream(md):
         # Make sure registered data streams are initialized.
 
         if registered_data_streams == None:
-            samweb = get_samweb()
-            registered_data_streams = samweb.listValues('data_streams')
+            registered_data_streams = set(get_registered_data_streams())
 
         # Check whether this data_stream is registered.
 
@@ -319,42 +539,148 @@ def validate_data_stream(md):
     return
 
 
-# Function to extract metadata as python dictionary.
+# Run command, and return a tuple (stdout, returncode), where stdout is the
+# standard output as bytes.  Standard error is discarded (not buffered).
 
-def get_metadata(artroot):
+def run_command(cmd):
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        data = proc.stdout.read()
+        returncode = proc.wait()
+    return data, returncode
 
-    # Run sam_metadata_dumper.
+
+# Run sam_metadata_dumper for a single artroot file.
+# If sam_metadata_dumper fails, read metadata from corresponding json file.
+# Return value is the raw metadata as python dictionary.
+
+def run_metadata_dumper(artroot):
 
     md = {}
+    found = False
     cmd = ['sam_metadata_dumper', artroot]
-    proc = subprocess.run(cmd, capture_output=True, encoding='utf8')
-    if proc.returncode == 0:
+    if ijson != None:
 
-        # Sam_metadata_dumper succeeded.
-        # Parse json output into python dictionary.
+        # Stream json output from sam_metadata_dumper.
+        # Only the first (file name) entry is parsed.
 
-        md0 = json.loads(proc.stdout)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for k, v in ijson.kvitems(proc.stdout, '', use_float=True):
+                md = v
+                md['file_name'] = k
+                found = True
+                break
+        except ijson.JSONError:
+            pass
+        proc.stdout.close()
+        proc.wait()
+        returncode = proc.returncode
 
-        # Loop over one key to extract file name.
+    else:
+        data, returncode = run_command(cmd)
+        if returncode == 0:
 
-        for k in md0:
-            md = md0[k]
-            md['file_name'] = k
-            break
+            # Sam_metadata_dumper succeeded.
+            # Parse json output into python dictionary.
+            # Release output buffer as soon as it is parsed.
 
-    else:
+            md0 = json_loads(data)
+            del data
+
+            # Loop over one key to extract file name.
+
+            for k in md0:
+                md = md0[k]
+                md['file_name'] = k
+                found = True
+                break
+
+    if not found:
 
         # Sam_metadata_dumper failed.
         # Try to read metadata for corrsponding json file.
 
         jsonfile = matching_json_file(artroot)
         if jsonfile != '':
-            f = open(jsonfile)
-            md = json.load(f)
+            with open(jsonfile, 'rb') as f:
+                md = json_loads(f.read())
         else:
-            print('sam_metadata_dumper returned status %d' % proc.returncode)
+            print('sam_metadata_dumper returned status %d' % returncode)
             print('No corresponding json file found, giving up.')
-            sys.exit(proc.returncode)
+            sys.exit(returncode or 1)
+
+    # Done.
+
+    return md
+
+
+# Run sam_metadata_dumper for a single artroot file, reusing the result of an
+# earlier call for the same file, unless the file was modified since.
+# Return value is a copy of the raw metadata, which the caller may modify.
+# Argument st is the result of os.stat for this file (None if file doesn't exist).
+
+def cached_metadata_dumper(artroot, st):
+    path = os.path.abspath(artroot)
+    key = (path, None)
+    if st != None:
+        key = (path, st.st_mtime_ns)
+    if key not in dumper_cache:
+        dumper_cache[key] = run_metadata_dumper(artroot)
+    return copy.deepcopy(dumper_cache[key])
+
+
+# Run sam_metadata_dumper once for a list of artroot files.
+# Return value is a dictionary {artroot: metadata}, containing the files for
+# which sam_metadata_dumper returned metadata.
+# Returns an empty dictionary if sam_metadata_dumper failed for any file.
+
+def dump_metadata(artroots):
+
+    result = {}
+    if len(artroots) == 0:
+        return result
+    cmd = ['sam_metadata_dumper'] + list(artroots)
+    data, returncode = run_command(cmd)
+    if returncode == 0:
+
+        # Match dumper output to artroot files by file name.
+
+        md0 = json_loads(data)
+        del data
+        keys = {}
+        for k in md0:
+            keys[os.path.basename(k)] = k
+        for artroot in artroots:
+            fname = os.path.basename(artroot)
+            if fname in keys:
+                md = md0[keys[fname]]
+                md['file_name'] = keys[fname]
+                result[artroot] = md
+
+    # Done.
+
+    return result
+
+
+# Function to extract metadata as python dictionary.
+# Optional argument md0 is the sam_metadata_dumper output for this file,
+# if it has already been extracted (see dump_metadata).
+# Optional argument st is the result of os.stat for this file, if it has
+# already been stat'ed (otherwise, the file is stat'ed here).
+
+def get_metadata(artroot, md0=None, st=None):
+
+    if st == None:
+        try:
+            st = os.stat(artroot)
+        except OSError:
+            st = None
+
+    # Run sam_metadata_dumper, unless this has already been done.
+
+    md = md0
+    if md == None:
+        md = cached_metadata_dumper(artroot, st)
 
     # Do metadata checks and updates here.
     # Make sure metadata contains file name.
@@ -365,9 +691,8 @@ def get_metadata(artroot):
     # Make sure metadata contains file size, if we have access to the original file.
     # Preexisting file_size in metadata, if any, is ignored.
 
-    if os.path.exists(artroot):
-        stat = os.stat(artroot)
-        md['file_size'] = stat.st_size
+    if st != None:
+        md['file_size'] = st.st_size
 
     # Make sure application family/name/version is its own dictionary
 
@@ -411,58 +736,90 @@ def main(argv):
 
     global experiment
 
+    # Start with empty parent caches.
+
+    parent_md_cache.clear()
+    local_md_cache.clear()
+    json_dir_cache.clear()
+    dumper_cache.clear()
+
     # Parse arguments.
 
-    artroot = ''
     experiment = ''
     if 'SAM_EXPERIMENT' in os.environ:
         experiment = os.environ['SAM_EXPERIMENT']
 
-    args = argv[1:]
-    while len(args) > 0:
-        if args[0] == '-h' or args[0] == '--help' :
-            help()
-            return 0
-        elif (args[0] == '-e' or args[0] == '--experiment') and len(args) > 1:
-            experiment = args[1]
-            del args[0:2]
-        elif args[0].startswith('-'):
-            print('Unknown option %s' % args[0])
-            sys.exit(1)
-        else:
-
-            # Positional arguments.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('-e', '--experiment', default=experiment)
+    parser.add_argument('artroots', nargs='*')
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.help:
+        help()
+        return 0
+    if len(unknown) > 0:
+        print('Unknown option %s' % unknown[0])
+        sys.exit(1)
 
-            if artroot == '':
-                artroot = args[0]
-                del args[0]
-            else:
-                print('More than one positional argument not allowed.')
-                sys.exit(1)
+    experiment = args.experiment
+    artroots = args.artroots
 
     # Check validity of options and arguments.
 
-    if artroot == '':
+    if len(artroots) == 0:
         print('No artroot file specified.')
         sys.exit(1)
 
-    if not os.path.exists(artroot) and matching_json_file(artroot) == '':
-        print('Artroot file %s does not exist and there is no corresponding json file.' % artroot)
-        sys.exit(1)
+    # Metadata are matched and printed by file name, so file names must be unique.
+
+    fnames = set()
+    for artroot in artroots:
+        fname = os.path.basename(artroot)
+        if fname in fnames:
+            print('Duplicate artroot file name %s.' % fname)
+            sys.exit(1)
+        fnames.add(fname)
+
+    # Each file is stat'ed once {artroot: stat} (stat is None if file doesn't exist).
+
+    stats = {}
+    for artroot in artroots:
+        try:
+            stats[artroot] = os.stat(artroot)
+        except OSError:
+            stats[artroot] = None
+        if stats[artroot] == None and matching_json_file(artroot) == '':
+            print('Artroot file %s does not exist and there is no corresponding json file.' % artroot)
+            sys.exit(1)
 
-    # Extract metadata as python dictionary.
+    # For multiple files, run sam_metadata_dumper once for all existing files.
+    # Files that are missing from the combined output are handled one at a time.
 
-    md = get_metadata(artroot)
+    dumped = {}
+    if len(artroots) > 1:
+        dumped = dump_metadata([artroot for artroot in artroots if stats[artroot] != None])
 
-    # Validate parent metadata.
+    mds = {}
+    for artroot in artroots:
 
-    dir = os.path.dirname(os.path.abspath(artroot))
-    validate_parents(md, dir)
+        # Extract metadata as python dictionary.
+
+        md = get_metadata(artroot, dumped.get(artroot), stats[artroot])
+
+        # Validate parent metadata.
+
+        dir = os.path.dirname(os.path.abspath(artroot))
+        validate_parents(md, dir)
+        mds[md['file_name']] = md
 
     # Pretty print json metadata.
+    # For a single file, print its metadata.
+    # For multiple files, print a dictionary {file_name: metadata}.
 
-    json.dump(md, sys.stdout, sort_keys=True, indent=2)
-    print()   # Json dump misses final newline.
+    if len(artroots) == 1:
+        json_print(md)
+    else:
+        json_print(mds)
 
     # Done
 